@@ -0,0 +1,205 @@
+import asyncio
+import csv
+import io
+import json
+import logging
+
+from aiogram import Bot, F, Router, types
+from aiogram.filters import Command, CommandObject
+
+import analytics
+import broadcast
+import config
+import database
+
+logger = logging.getLogger(__name__)
+
+router = Router(name='admin')
+# Весь роутер доступен только администратору; при ADMIN_USER_ID = 0 он фактически выключен
+router.message.filter(F.from_user.id == config.ADMIN_USER_ID)
+
+commands = [
+    '/add_burger Название | Описание | Цена - Добавить бургер',
+    '/edit_burger ID поле значение - Изменить name, description или price',
+    '/remove_burger ID - Удалить бургер',
+    '/import - Загрузить CSV или JSON (отправьте файл с этой подписью)',
+    '/stats [day|hour] [N] - Продажи за последние N дней или часов',
+    '/broadcast текст - Разослать сообщение всем пользователям',
+    '/broadcast_status - Ход последней рассылки',
+    '/broadcast_cancel - Остановить рассылку'
+]
+
+MAX_STATS_PERIODS = 90
+
+MAX_IMPORT_ERRORS = 10
+
+
+class ImportFileError(ValueError):
+    pass
+
+
+def parse_price(value):
+    price = int(str(value).strip())
+    if price <= 0:
+        raise ValueError('цена должна быть положительной')
+    return price
+
+
+def parse_row(record):
+    burger_id = str(record.get('id') or '').strip()
+    name = str(record.get('name') or '').strip()
+    description = str(record.get('description') or '').strip()
+    if not name:
+        raise ValueError('не указано название')
+    return (int(burger_id) if burger_id else None, name, description, parse_price(record.get('price')))
+
+
+def parse_import(data, filename):
+    text = data.decode('utf-8-sig')
+    if filename.lower().endswith('.json'):
+        records = json.loads(text)
+        if not isinstance(records, list):
+            raise ImportFileError('JSON должен содержать список объектов')
+    else:
+        records = list(csv.DictReader(io.StringIO(text)))
+
+    rows = []
+    errors = []
+    for number, record in enumerate(records, start=1):
+        try:
+            if not isinstance(record, dict):
+                raise ValueError('ожидался объект')
+            rows.append(parse_row(record))
+        except (TypeError, ValueError) as e:
+            errors.append(f'строка {number}: {e}')
+            if len(errors) >= MAX_IMPORT_ERRORS:
+                break
+    if errors:
+        raise ImportFileError('\n'.join(errors))
+    return rows
+
+
+@router.message(Command('admin'))
+async def admin_help(message: types.Message):
+    await message.reply('Команды администратора:\n' + '\n'.join(commands))
+
+
+@router.message(Command('add_burger'))
+async def admin_add_burger(message: types.Message, command: CommandObject):
+    parts = [part.strip() for part in (command.args or '').split('|')]
+    if len(parts) != 3 or not parts[0]:
+        await message.reply('Формат: /add_burger Название | Описание | Цена')
+        return
+
+    try:
+        price = parse_price(parts[2])
+    except ValueError:
+        await message.reply('Цена должна быть положительным целым числом.')
+        return
+
+    burger_id = await database.async_add_burger(parts[0], parts[1], price)
+    await message.reply(f'Бургер {parts[0]} добавлен, ID {burger_id}.')
+
+
+@router.message(Command('edit_burger'))
+async def admin_edit_burger(message: types.Message, command: CommandObject):
+    parts = (command.args or '').split(maxsplit=2)
+    if len(parts) != 3 or not parts[0].isdigit() or parts[1] not in database.BURGER_FIELDS:
+        await message.reply('Формат: /edit_burger ID name|description|price значение')
+        return
+
+    burger_id, field, value = int(parts[0]), parts[1], parts[2].strip()
+    if field == 'price':
+        try:
+            value = parse_price(value)
+        except ValueError:
+            await message.reply('Цена должна быть положительным целым числом.')
+            return
+
+    if await database.async_update_burger(burger_id, field, value):
+        await message.reply(f'Бургер {burger_id} обновлён.')
+    else:
+        await message.reply('Бургер не найден.')
+
+
+@router.message(Command('remove_burger'))
+async def admin_remove_burger(message: types.Message, command: CommandObject):
+    if not command.args or not command.args.strip().isdigit():
+        await message.reply('Формат: /remove_burger ID')
+        return
+
+    if await database.async_remove_burger(int(command.args)):
+        await message.reply('Бургер удалён.')
+    else:
+        await message.reply('Бургер не найден.')
+
+
+@router.message(Command('import'), F.document)
+async def admin_import_burgers(message: types.Message, bot: Bot):
+    document = message.document
+    data = await bot.download(document)
+    # Разбор тысяч строк - в отдельном потоке, чтобы не держать цикл событий
+    try:
+        rows = await asyncio.to_thread(parse_import, data.read(), document.file_name or '')
+    except (csv.Error, ValueError) as e:
+        await message.reply(f'Файл не загружен:\n{e}')
+        return
+
+    if not rows:
+        await message.reply('В файле нет бургеров.')
+        return
+
+    count = await database.async_import_burgers(rows)
+    logger.info('Импортировано бургеров: %d', count)
+    await message.reply(f'Импортировано бургеров: {count}.')
+
+
+@router.message(Command('import'))
+async def admin_import_help(message: types.Message):
+    await message.reply('Отправьте CSV (колонки id, name, description, price) или JSON-список '
+                        'с подписью /import. Строки с существующим id обновляют бургер.')
+
+
+@router.message(Command('stats'))
+async def admin_stats(message: types.Message, command: CommandObject):
+    parts = (command.args or '').split()
+    by = parts[0] if parts else 'day'
+    periods = parts[1] if len(parts) > 1 else '7'
+    if len(parts) > 2 or by not in analytics.BUCKETS or not periods.isdigit() \
+            or not 0 < int(periods) <= MAX_STATS_PERIODS:
+        await message.reply(f'Формат: /stats [day|hour] [1-{MAX_STATS_PERIODS}]')
+        return
+
+    report = await analytics.build_report(by, int(periods))
+    await message.reply(analytics.format_report(report))
+
+
+@router.message(Command('broadcast'))
+async def admin_start_broadcast(message: types.Message, command: CommandObject, bot: Bot):
+    text = (command.args or '').strip()
+    if not text:
+        await message.reply('Формат: /broadcast текст сообщения')
+        return
+
+    broadcast_id = await broadcast.engine.start(bot, text)
+    if broadcast_id is None:
+        await message.reply(f'Уже идёт рассылка {broadcast.engine.current}. Остановить: /broadcast_cancel')
+        return
+    await message.reply(f'Рассылка {broadcast_id} запущена. Ход: /broadcast_status')
+
+
+@router.message(Command('broadcast_status'))
+async def admin_broadcast_status(message: types.Message):
+    rows = await database.async_get_broadcasts()
+    if not rows:
+        await message.reply('Рассылок ещё не было.')
+        return
+    await message.reply(broadcast.format_stats(rows[0]))
+
+
+@router.message(Command('broadcast_cancel'))
+async def admin_cancel_broadcast(message: types.Message):
+    if await broadcast.engine.cancel():
+        await message.reply('Рассылка остановлена.')
+    else:
+        await message.reply('Рассылка не идёт.')
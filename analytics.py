@@ -0,0 +1,115 @@
+import argparse
+import asyncio
+import csv
+import json
+import sys
+import time
+
+import config
+import database
+
+HOUR = 60 * 60
+DAY = 24 * HOUR
+BUCKETS = {'hour': HOUR, 'day': DAY}
+TOP_LIMIT = 5
+
+
+async def build_report(by='day', periods=7, now=None, top=TOP_LIMIT):
+    # Отчёт читает только почасовые сводки, поэтому не зависит от числа платежей
+    bucket = BUCKETS[by]
+    now = int(time.time() if now is None else now)
+    until = (now // bucket + 1) * bucket
+    since = until - periods * bucket
+    rows = await database.async_sales_report(since, until, bucket)
+    burgers = await database.async_top_burgers(since, until, top)
+    return {
+        'by': by,
+        'since': since,
+        'until': until,
+        'periods': [
+            {'period': period, 'currency': currency, 'orders': orders, 'revenue': revenue}
+            for period, currency, orders, revenue in rows
+        ],
+        'top_burgers': [
+            {'burger_id': burger_id, 'name': name, 'quantity': quantity, 'revenue': revenue}
+            for burger_id, name, quantity, revenue in burgers
+        ]
+    }
+
+
+def format_period(timestamp, by):
+    return time.strftime('%d.%m %H:00' if by == 'hour' else '%d.%m.%Y', time.gmtime(timestamp))
+
+
+def format_report(report):
+    if not report['periods']:
+        return 'Продаж за выбранный период нет.'
+
+    totals = {}
+    lines = ['Продажи (время UTC):']
+    for row in report['periods']:
+        lines.append(f"{format_period(row['period'], report['by'])}: {row['orders']} зак., "
+                     f"{row['revenue']} {row['currency']}")
+        orders, revenue = totals.get(row['currency'], (0, 0))
+        totals[row['currency']] = (orders + row['orders'], revenue + row['revenue'])
+
+    lines.append('')
+    for currency, (orders, revenue) in totals.items():
+        lines.append(f'Итого: {orders} зак., {revenue} {currency}')
+
+    if report['top_burgers']:
+        lines.append('')
+        lines.append('Популярные бургеры:')
+        for number, burger in enumerate(report['top_burgers'], start=1):
+            lines.append(f"{number}. {burger['name']} - {burger['quantity']} шт., {burger['revenue']}")
+    return '\n'.join(lines)
+
+
+def write_csv(report, file):
+    writer = csv.writer(file)
+    writer.writerow(['period', 'currency', 'orders', 'revenue'])
+    for row in report['periods']:
+        period = time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime(row['period']))
+        writer.writerow([period, row['currency'], row['orders'], row['revenue']])
+
+
+async def export(args):
+    await database.open_storage()
+    try:
+        # Выгрузка только читает: миграции применяет бот при запуске
+        if await database.async_get_schema_version() < len(database.MIGRATIONS):
+            raise SystemExit(f'Схема базы {args.db} устарела: запустите бота, чтобы применить миграции')
+        return await build_report(args.by, args.periods, top=args.top)
+    finally:
+        await database.close_storage()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Выгрузка продаж из почасовых сводок')
+    parser.add_argument('--db', default=config.DATABASE_PATH, help='файл базы')
+    parser.add_argument('--by', choices=sorted(BUCKETS), default='day', help='группировка по часам или дням')
+    parser.add_argument('--periods', type=int, default=30, help='число последних часов или дней')
+    parser.add_argument('--top', type=int, default=TOP_LIMIT, help='сколько популярных бургеров включить в JSON')
+    parser.add_argument('--format', choices=('csv', 'json', 'text'), default='csv', help='формат выгрузки')
+    parser.add_argument('--output', help='файл для выгрузки; по умолчанию - стандартный вывод')
+    args = parser.parse_args()
+
+    database.configure(args.db, read_only=True)
+    report = asyncio.run(export(args))
+
+    file = open(args.output, 'w', newline='', encoding='utf-8') if args.output else sys.stdout
+    try:
+        if args.format == 'json':
+            json.dump(report, file, ensure_ascii=False, indent=2)
+            file.write('\n')
+        elif args.format == 'text':
+            file.write(format_report(report) + '\n')
+        else:
+            write_csv(report, file)
+    finally:
+        if args.output:
+            file.close()
+
+
+if __name__ == '__main__':
+    main()
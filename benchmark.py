@@ -0,0 +1,516 @@
+import argparse
+import asyncio
+import contextvars
+import functools
+import itertools
+import json
+import logging
+import math
+import multiprocessing
+import os
+import platform
+import random
+import socket
+import sys
+import tempfile
+import time
+from collections import defaultdict
+
+from aiohttp import web
+
+import config
+
+# Настройки должны быть заданы до импорта bot: модули читают их при загрузке
+config.TOKEN = '123456:BENCHMARK'
+config.SEND_GLOBAL_RATE = 1_000_000
+config.SEND_CHAT_RATE = 1_000_000
+config.SEND_CHAT_BURST = 1_000_000
+config.METRICS_PORT = 0
+config.LOG_LEVEL = 'WARNING'
+
+import logs
+
+from aiogram import BaseMiddleware
+from aiogram.client.session.aiohttp import AiohttpSession
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware
+from aiogram.client.telegram import TelegramAPIServer
+from aiogram.methods import SendInvoice
+
+USER_ID_BASE = 10_000_000
+
+ROUTES = (
+    'start', 'list_burgers', 'burger_details', 'increase_quantity', 'increase_quantity',
+    'decrease_quantity', 'add_to_cart', 'view_cart', 'buy', 'pre_checkout', 'successful_payment'
+)
+
+_db_time = contextvars.ContextVar('db_time', default=None)
+_background_db_time = defaultdict(float)
+
+
+# Подставной Bot API: отвечает правдоподобными объектами без обращения к Telegram
+
+def _fake_api_app():
+    message_ids = itertools.count(1)
+
+    async def handle(request):
+        method = request.match_info['method']
+        data = await request.post()
+        if method in ('sendMessage', 'sendInvoice', 'editMessageText', 'editMessageReplyMarkup'):
+            chat_id = int(data.get('chat_id', 0))
+            result = {
+                'message_id': next(message_ids),
+                'date': int(time.time()),
+                'chat': {'id': chat_id, 'type': 'private'},
+                'text': data.get('text', '')
+            }
+        elif method == 'getMe':
+            result = {'id': 123456, 'is_bot': True, 'first_name': 'Benchmark', 'username': 'benchmark_bot'}
+        else:
+            result = True
+        return web.json_response({'ok': True, 'result': result})
+
+    app = web.Application()
+    app.router.add_post('/bot{token}/{method}', handle)
+    return app
+
+
+def _serve_fake_api(sock):
+    logging.getLogger('aiohttp.access').setLevel(logging.WARNING)
+    web.run_app(_fake_api_app(), sock=sock, print=None, handle_signals=True)
+
+
+def start_fake_api():
+    sock = socket.socket()
+    sock.bind(('127.0.0.1', 0))
+    sock.listen(1024)
+    process = multiprocessing.get_context('fork').Process(target=_serve_fake_api, args=(sock,), daemon=True)
+    process.start()
+    url = 'http://127.0.0.1:%d' % sock.getsockname()[1]
+    sock.close()
+    return process, url
+
+
+class InvoiceCapture(BaseRequestMiddleware):
+    def __init__(self):
+        self.invoices = {}
+
+    async def __call__(self, make_request, bot, method):
+        if isinstance(method, SendInvoice):
+            self.invoices[method.chat_id] = (method.payload, method.prices[0].amount)
+        return await make_request(bot, method)
+
+
+def _timed(function):
+    name = function.__name__
+
+    @functools.wraps(function)
+    async def wrapper(*args, **kwargs):
+        started = time.perf_counter()
+        try:
+            return await function(*args, **kwargs)
+        finally:
+            elapsed = time.perf_counter() - started
+            spent = _db_time.get()
+            if spent is None:
+                # Очередь заказов и сброс состояний работают в своих задачах, вне контекста обновления
+                _background_db_time[name] += elapsed
+            else:
+                spent[0] += elapsed
+    return wrapper
+
+
+def instrument_database(database):
+    for name in dir(database):
+        if name.startswith('async_') and asyncio.iscoroutinefunction(getattr(database, name)):
+            setattr(database, name, _timed(getattr(database, name)))
+
+
+class UpdateTracker(BaseMiddleware):
+    # Внешняя middleware: время в БД на обновление, ошибки и, в шардированном режиме, сигнал фронту
+    # о завершении обновления вместе с перехваченным счётом
+    def __init__(self, capture, completions=None):
+        self.capture = capture
+        self.completions = completions
+        self.db_time = []
+        self.errors = 0
+
+    async def __call__(self, handler, event, data):
+        spent = [0.0]
+        token = _db_time.set(spent)
+        try:
+            return await handler(event, data)
+        except Exception:
+            self.errors += 1
+            raise
+        finally:
+            _db_time.reset(token)
+            self.db_time.append(spent[0])
+            if self.completions is not None:
+                user = data.get('event_from_user')
+                invoice = self.capture.invoices.pop(user.id, None) if user else None
+                self.completions.put((event.update_id, invoice))
+
+    def stats(self):
+        return {'db_time': self.db_time, 'errors': self.errors, 'db_background': dict(_background_db_time)}
+
+
+# Синтетический трафик
+
+def _user(user_id):
+    return {'id': user_id, 'is_bot': False, 'first_name': f'user{user_id}'}
+
+
+def _chat(user_id):
+    return {'id': user_id, 'type': 'private'}
+
+
+def command_update(update_id, user_id, text):
+    return {'update_id': update_id, 'message': {
+        'message_id': update_id, 'date': 0, 'chat': _chat(user_id), 'from': _user(user_id), 'text': text,
+        'entities': [{'type': 'bot_command', 'offset': 0, 'length': len(text)}]
+    }}
+
+
+def callback_update(update_id, user_id, data):
+    return {'update_id': update_id, 'callback_query': {
+        'id': str(update_id), 'from': _user(user_id), 'chat_instance': str(user_id), 'data': data,
+        'message': {'message_id': update_id, 'date': 0, 'chat': _chat(user_id), 'text': '...'}
+    }}
+
+
+def pre_checkout_update(update_id, user_id, payload, amount):
+    return {'update_id': update_id, 'pre_checkout_query': {
+        'id': str(update_id), 'from': _user(user_id), 'currency': 'XTR',
+        'total_amount': amount, 'invoice_payload': payload
+    }}
+
+
+def payment_update(update_id, user_id, payload, amount):
+    return {'update_id': update_id, 'message': {
+        'message_id': update_id, 'date': 0, 'chat': _chat(user_id), 'from': _user(user_id),
+        'successful_payment': {
+            'currency': 'XTR', 'total_amount': amount, 'invoice_payload': payload,
+            'telegram_payment_charge_id': f'bench-{update_id}', 'provider_payment_charge_id': ''
+        }
+    }}
+
+
+async def simulate_user(feed, invoices, callbacks, user_id, burger_id, update_ids):
+    QuantityCallback = callbacks.QuantityCallback
+
+    await feed('start', command_update(next(update_ids), user_id, '/start'))
+    await feed('list_burgers', command_update(next(update_ids), user_id, '/burgers'))
+    await feed('burger_details', callback_update(next(update_ids), user_id, f'burger_{burger_id}'))
+    for quantity in (1, 2):
+        data = QuantityCallback.signed('increase', burger_id, quantity).pack()
+        await feed('increase_quantity', callback_update(next(update_ids), user_id, data))
+    data = QuantityCallback.signed('decrease', burger_id, 3).pack()
+    await feed('decrease_quantity', callback_update(next(update_ids), user_id, data))
+    data = QuantityCallback.signed('add', burger_id, 2).pack()
+    await feed('add_to_cart', callback_update(next(update_ids), user_id, data))
+    await feed('view_cart', command_update(next(update_ids), user_id, '/cart'))
+    await feed('buy', callback_update(next(update_ids), user_id, 'buy'))
+
+    invoice = invoices.pop(user_id, None)
+    if invoice is None:
+        return False
+    payload, amount = invoice
+    await feed('pre_checkout', pre_checkout_update(next(update_ids), user_id, payload, amount))
+    await feed('successful_payment', payment_update(next(update_ids), user_id, payload, amount))
+    return True
+
+
+async def run_users(simulate, user_ids, burger_ids, concurrency, seed):
+    rng = random.Random(seed)
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def run_user(user_id, burger_id):
+        async with semaphore:
+            return await simulate(user_id, burger_id)
+
+    started = time.perf_counter()
+    results = await asyncio.gather(*(run_user(user_id, rng.choice(burger_ids)) for user_id in user_ids))
+    # Пользователь без счёта - ошибка сценария, даже если обработчики не упали
+    return time.perf_counter() - started, results.count(False)
+
+
+def use_fake_api(bot_module, api_url, capture):
+    session = AiohttpSession(api=TelegramAPIServer.from_base(api_url))
+    session.middleware(bot_module.sender.scheduler)
+    session.middleware(capture)
+    bot_module.bot.session = session
+
+
+async def run_single(api_url, user_ids, burger_ids, concurrency, seed):
+    import bot as bot_module
+    import database
+
+    instrument_database(database)
+    capture = InvoiceCapture()
+    use_fake_api(bot_module, api_url, capture)
+    tracker = UpdateTracker(capture)
+    bot_module.dp.update.outer_middleware(tracker)
+
+    await bot_module.startup()
+    _background_db_time.clear()
+    latency = defaultdict(list)
+    update_ids = itertools.count(1)
+
+    async def feed(route, raw):
+        started = time.perf_counter()
+        try:
+            await bot_module.dp.feed_raw_update(bot_module.bot, raw)
+        except Exception:
+            pass  # ошибку уже посчитал UpdateTracker
+        latency[route].append(time.perf_counter() - started)
+
+    async def simulate(user_id, burger_id):
+        return await simulate_user(feed, capture.invoices, bot_module.callbacks, user_id, burger_id, update_ids)
+
+    try:
+        elapsed, failed = await run_users(simulate, user_ids, burger_ids, concurrency, seed)
+    finally:
+        await bot_module.shutdown()
+    stats = tracker.stats()
+    return {'elapsed': elapsed, 'latency': dict(latency), 'db_time': stats['db_time'],
+            'errors': stats['errors'] + failed, 'db_background': stats['db_background']}
+
+
+def run_sharded(apis, user_ids, burger_ids, concurrency, seed, workers):
+    # Настоящий шардированный режим: воркеры и маршрутизация по каналам из sharding,
+    # а фронтом вместо getUpdates выступает генератор нагрузки
+    import bot as bot_module
+    import database
+    import sharding
+
+    completions = multiprocessing.get_context('fork').Queue()
+    capture = InvoiceCapture()
+    tracker = UpdateTracker(capture, completions)
+
+    async def startup():
+        instrument_database(database)
+        use_fake_api(bot_module, apis[sharding.worker[0]][1], capture)
+        bot_module.dp.update.outer_middleware(tracker)
+        await bot_module.startup()
+        _background_db_time.clear()
+
+    async def shutdown():
+        await bot_module.shutdown()
+        completions.put(('stats', tracker.stats()))
+
+    processes, socks = sharding.start_workers(bot_module.bot, bot_module.dp, startup, shutdown, workers)
+    try:
+        return asyncio.run(_run_front(socks, completions, bot_module.callbacks, user_ids, burger_ids,
+                                      concurrency, seed, workers))
+    finally:
+        sharding.join_workers(processes)
+
+
+async def _run_front(socks, completions, callbacks, user_ids, burger_ids, concurrency, seed, workers):
+    import sharding
+
+    loop = asyncio.get_running_loop()
+    writers = [(await asyncio.open_connection(sock=sock))[1] for sock in socks]
+    router = sharding.ShardRouter(writers)
+    pending = {}
+    invoices = {}
+    stats = []
+    latency = defaultdict(list)
+    timeouts = 0
+    update_ids = itertools.count(1)
+    all_stats = loop.create_future()
+
+    def receive():
+        while len(stats) < workers:
+            message = completions.get()
+            if message[0] == 'stats':
+                stats.append(message[1])
+                continue
+            loop.call_soon_threadsafe(complete, *message)
+        loop.call_soon_threadsafe(all_stats.set_result, None)
+
+    def complete(update_id, invoice):
+        future = pending.pop(update_id, None)
+        if future is not None and not future.done():
+            future.set_result(invoice)
+
+    async def feed(route, raw):
+        nonlocal timeouts
+        future = pending[raw['update_id']] = loop.create_future()
+        started = time.perf_counter()
+        await router.route(raw)
+        try:
+            invoice = await asyncio.wait_for(future, timeout=30)
+        except asyncio.TimeoutError:
+            pending.pop(raw['update_id'], None)
+            timeouts += 1
+            return
+        latency[route].append(time.perf_counter() - started)
+        if invoice is not None:
+            invoices[sharding.update_user_id(raw)] = invoice
+
+    async def simulate(user_id, burger_id):
+        return await simulate_user(feed, invoices, callbacks, user_id, burger_id, update_ids)
+
+    receiver = loop.run_in_executor(None, receive)
+    try:
+        elapsed, failed = await run_users(simulate, user_ids, burger_ids, concurrency, seed)
+    finally:
+        # Закрытие каналов останавливает воркеры, после shutdown они присылают статистику
+        for writer in writers:
+            writer.close()
+    await all_stats
+    await receiver
+
+    background = defaultdict(float)
+    for worker_stats in stats:
+        for name, spent in worker_stats['db_background'].items():
+            background[name] += spent
+    return {
+        'elapsed': elapsed,
+        'latency': dict(latency),
+        'db_time': [value for worker_stats in stats for value in worker_stats['db_time']],
+        'errors': sum(worker_stats['errors'] for worker_stats in stats) + timeouts + failed,
+        'db_background': dict(background)
+    }
+
+
+def prepare_database(path, burgers):
+    import database
+
+    database.configure(path)
+    database.init_db()
+    database.import_burgers([
+        (None, f'Бургер №{number}', f'Описание бургера №{number}', 1 + number % 5)
+        for number in range(1, burgers + 1)
+    ])
+    return [burger[0] for burger in database.get_burgers()]
+
+
+def percentile(values, percent):
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[max(math.ceil(percent / 100 * len(ordered)) - 1, 0)]
+
+
+def summarize(args, result):
+    latency = result['latency']
+    db_time = result['db_time']
+    background = result['db_background']
+    updates = sum(len(values) for values in latency.values())
+    elapsed = result['elapsed']
+    all_latency = [value for values in latency.values() for value in values]
+    background_total = sum(background.values())
+
+    def stats(values):
+        return {
+            'count': len(values),
+            'p50_ms': percentile(values, 50) * 1000,
+            'p95_ms': percentile(values, 95) * 1000,
+            'p99_ms': percentile(values, 99) * 1000
+        }
+
+    return {
+        'params': {
+            'users': args.users, 'burgers': args.burgers, 'concurrency': args.concurrency,
+            'workers': args.workers, 'seed': args.seed
+        },
+        'environment': {'python': platform.python_version(), 'platform': platform.platform()},
+        'updates': updates,
+        'errors': result['errors'],
+        'elapsed_s': elapsed,
+        'throughput_ups': updates / elapsed if elapsed else 0.0,
+        'latency': stats(all_latency),
+        'db_ms_per_update': {
+            'mean': sum(db_time) / len(db_time) * 1000 if db_time else 0.0,
+            'p95': percentile(db_time, 95) * 1000
+        },
+        # Запись платежей и состояний идёт в фоновых задачах и в время обновлений не попадает
+        'db_background_ms': {
+            'total': background_total * 1000,
+            'per_update': background_total / updates * 1000 if updates else 0.0,
+            'queries': {name: spent * 1000 for name, spent in sorted(background.items(), key=lambda item: -item[1])}
+        },
+        'routes': {route: stats(latency[route]) for route in dict.fromkeys(ROUTES) if route in latency}
+    }
+
+
+def print_report(report, baseline=None):
+    print(f"Обновлений: {report['updates']}, ошибок: {report['errors']}, время: {report['elapsed_s']:.2f} с")
+    line = f"Пропускная способность: {report['throughput_ups']:.0f} обн/с"
+    if baseline:
+        change = (report['throughput_ups'] / baseline['throughput_ups'] - 1) * 100
+        line += f' ({change:+.1f}% к базовому прогону)'
+    print(line)
+    db = report['db_ms_per_update']
+    print(f"Время в БД на обновление: среднее {db['mean']:.3f} мс, p95 {db['p95']:.3f} мс")
+    background = report.get('db_background_ms')
+    if background:
+        queries = ', '.join(f'{name} {spent:.0f}' for name, spent in list(background['queries'].items())[:3])
+        print(f"Фоновая работа с БД: всего {background['total']:.0f} мс, {background['per_update']:.3f} мс "
+              f"на обновление ({queries or 'нет'})")
+    print()
+    print(f"{'маршрут':<20}{'кол-во':>8}{'p50 мс':>10}{'p95 мс':>10}{'p99 мс':>10}")
+    for route, stats in [('ВСЕ', report['latency']), *report['routes'].items()]:
+        line = f"{route:<20}{stats['count']:>8}{stats['p50_ms']:>10.2f}{stats['p95_ms']:>10.2f}{stats['p99_ms']:>10.2f}"
+        if baseline:
+            previous = baseline['latency'] if route == 'ВСЕ' else baseline['routes'].get(route)
+            if previous and previous['p95_ms']:
+                line += f"  p95 {(stats['p95_ms'] / previous['p95_ms'] - 1) * 100:+.1f}%"
+        print(line)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Нагрузочный прогон бота на подставном Bot API')
+    parser.add_argument('--users', type=int, default=2000, help='число симулируемых пользователей')
+    parser.add_argument('--burgers', type=int, default=50, help='размер каталога')
+    parser.add_argument('--concurrency', type=int, default=200, help='одновременно активных пользователей')
+    parser.add_argument('--workers', type=int, default=1, help='число процессов с шардированием по user_id')
+    parser.add_argument('--db', help='файл базы (например, на tmpfs) или :memory: (с грязными чтениями); '
+                        'по умолчанию - во временном каталоге')
+    parser.add_argument('--seed', type=int, default=1, help='зерно генератора сценариев')
+    parser.add_argument('--json', help='сохранить результаты в файл')
+    parser.add_argument('--compare', help='сравнить с результатами из файла')
+    args = parser.parse_args()
+    import database
+
+    if args.db and args.workers > 1 and database.is_memory_path(args.db):
+        parser.error('база в памяти не разделяется между процессами, используйте --workers 1')
+
+    logs.setup()
+    json_path = os.path.abspath(args.json) if args.json else None
+    compare_path = os.path.abspath(args.compare) if args.compare else None
+    db_path = args.db
+    if db_path and not database.is_memory_path(db_path):
+        db_path = os.path.abspath(db_path)
+    workdir = tempfile.mkdtemp(prefix='burgers-bench-')
+    os.chdir(workdir)
+    burger_ids = prepare_database(db_path or os.path.join(workdir, 'burgers.db'), args.burgers)
+
+    user_ids = [USER_ID_BASE + number for number in range(args.users)]
+    apis = [start_fake_api() for _ in range(args.workers)]
+
+    try:
+        if args.workers == 1:
+            result = asyncio.run(run_single(apis[0][1], user_ids, burger_ids, args.concurrency, args.seed))
+        else:
+            result = run_sharded(apis, user_ids, burger_ids, args.concurrency, args.seed, args.workers)
+    finally:
+        for process, _ in apis:
+            process.terminate()
+
+    report = summarize(args, result)
+    baseline = None
+    if compare_path:
+        with open(compare_path) as file:
+            baseline = json.load(file)
+    print(f'Каталог с данными прогона: {workdir}')
+    print_report(report, baseline)
+    if json_path:
+        with open(json_path, 'w') as file:
+            json.dump(report, file, ensure_ascii=False, indent=2)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,24 +1,44 @@
 import asyncio
-import atexit
 import logging
 from aiogram import Bot, Dispatcher, types
-from aiogram.types import InlineKeyboardButton, InlineKeyboardMarkup, LabeledPrice
+from aiogram.types import InlineKeyboardButton, InlineQueryResultArticle, InputTextMessageContent, LabeledPrice
+from aiogram.exceptions import TelegramBadRequest
 from aiogram.filters import Command
 from aiogram.utils.keyboard import InlineKeyboardBuilder
 from aiogram import F
-import aiosqlite  
 
+import admin
+import broadcast
+import callbacks
+import carts
+import catalog
 import config
 import database
-
-logging.basicConfig(
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
-    level=logging.INFO
-)
+import invoices
+import keyboards
+import lifecycle
+import logs
+import maintenance
+import metrics
+import ordering
+import orders
+import quantities
+import sender
+import sharding
+import stalls
+import states
+import webhook
+
+logs.setup()
 logger = logging.getLogger(__name__)
 
 bot = Bot(token=config.TOKEN)
+bot.session.middleware(sender.scheduler)
 dp = Dispatcher()
+dp.update.outer_middleware(lifecycle.inflight)
+metrics.setup(dp, bot)
+dp.update.outer_middleware(ordering.UserOrderMiddleware())
+dp.include_router(admin.router)
 
 commands = [
     '/start - Приветственное сообщение',
@@ -28,189 +48,175 @@ commands = [
 ]
 
 
-def stars_payment_keyboard():
-    keyboard = InlineKeyboardBuilder()
-    keyboard.button(text="Оплатить Stars", pay=True)
-    return keyboard.as_markup()
-
-
 @dp.message(Command("start"))
 async def start(message: types.Message):
     user_id = message.from_user.id
-    state = await database.async_get_user_state(user_id)
+    state = await states.store.get(user_id)
     if state:
-        await message.reply(f'Добро пожаловать обратно! Последний раз вы были: {state}')
+        greeting = f'Добро пожаловать обратно! Последний раз вы были: {state}'
     else:
-        await message.reply('Добро пожаловать в наш магазин бургеров!')
-    await database.async_save_user_state(user_id, 'start')
-    await message.reply('Доступные команды:\n' + '\n'.join(commands))
+        greeting = 'Добро пожаловать в наш магазин бургеров!'
+    await states.store.set(user_id, 'start')
+    await sender.together(
+        message.reply(greeting),
+        message.reply('Доступные команды:\n' + '\n'.join(commands))
+    )
 
 
 @dp.message(Command("help"))
 async def help_command(message: types.Message):
     user_id = message.from_user.id
-    await database.async_save_user_state(user_id, 'help')
+    await states.store.set(user_id, 'help')
     await message.reply('Доступные команды:\n' + '\n'.join(commands))
 
 
 @dp.message(Command("burgers"))
 async def list_burgers(message: types.Message):
     user_id = message.from_user.id
-    await database.async_save_user_state(user_id, 'burgers')
-    burgers = await database.async_get_burgers()
+    await states.store.set(user_id, 'burgers')
+    reply_markup = await keyboards.cache.menu_page()
 
-    if not burgers:
+    if not reply_markup:
         await message.reply('Бургеров пока нет.')
         return
 
-    keyboard = []
-    for burger in burgers:
-        keyboard.append([InlineKeyboardButton(text=burger[1], callback_data=f'burger_{burger[0]}')])
-
-    reply_markup = InlineKeyboardMarkup(inline_keyboard=keyboard)
     await message.reply('Выберите бургер:', reply_markup=reply_markup)
 
 
+@dp.callback_query(callbacks.MenuPage.filter())
+async def menu_page(callback_query: types.CallbackQuery, callback_data: callbacks.MenuPage):
+    await bot.answer_callback_query(callback_query.id)
+    reply_markup = await keyboards.cache.menu_page(callback_data.cursor, callback_data.direction == 'next')
+
+    if reply_markup is None or callback_query.message is None:
+        return
+
+    try:
+        await bot.edit_message_reply_markup(
+            chat_id=callback_query.message.chat.id,
+            message_id=callback_query.message.message_id,
+            reply_markup=reply_markup
+        )
+    except TelegramBadRequest as e:
+        if not quantities.is_not_modified(e):
+            raise
+
+
+def burger_text(burger):
+    return f'{burger[1]}\n\n{burger[2]}\n\nЦена: {burger[3]} ★'
+
+
+@dp.inline_query()
+async def search_burgers(inline_query: types.InlineQuery):
+    text = inline_query.query.strip()
+    next_offset = ''
+    if text:
+        burgers = await database.async_search_burgers(text, config.INLINE_RESULTS_LIMIT)
+    else:
+        # Пустой запрос - листаем меню целиком, offset хранит id последнего показанного бургера
+        cursor = int(inline_query.offset) if inline_query.offset.isdigit() else 0
+        burgers, _, has_next = await catalog.menu.get_page(cursor, size=config.INLINE_RESULTS_LIMIT)
+        if has_next:
+            next_offset = str(burgers[-1][0])
+
+    results = [
+        InlineQueryResultArticle(
+            id=str(burger[0]),
+            title=burger[1],
+            description=f'{burger[3]} ★ · {burger[2]}',
+            input_message_content=InputTextMessageContent(message_text=burger_text(burger)),
+            reply_markup=keyboards.cache.details(burger[0])
+        )
+        for burger in burgers
+    ]
+    await inline_query.answer(results, cache_time=30, next_offset=next_offset)
+
+
 @dp.callback_query(F.data.startswith('burger_'))
 async def burger_details(callback_query: types.CallbackQuery):
     await bot.answer_callback_query(callback_query.id)
     burger_id = int(callback_query.data.split('_')[1])
-    burgers = await database.async_get_burgers()
-    burger = next((b for b in burgers if b[0] == burger_id), None)
+    burger = await catalog.menu.get(burger_id)
+    user_id = callback_query.from_user.id
+    # Кнопка из inline-результата приходит без сообщения - отвечаем в личный чат
+    chat_id = callback_query.message.chat.id if callback_query.message else user_id
 
     if burger:
-        text = f'{burger[1]}\n\n{burger[2]}\n\nЦена: 1 ★'
-        user_id = callback_query.from_user.id
-        await database.async_save_user_state(user_id, f'awaiting_quantity_{burger_id}_1')
-
-        builder = InlineKeyboardBuilder()
-        builder.row(
-            InlineKeyboardButton(text='-', callback_data=f'decrease_{burger_id}'),
-            InlineKeyboardButton(text='1', callback_data=f'quantity_{burger_id}_1'),
-            InlineKeyboardButton(text='+', callback_data=f'increase_{burger_id}')
-        )
-        builder.row(
-            InlineKeyboardButton(text='Добавить в корзину', callback_data=f'add_to_cart_{burger_id}')
-        )
+        await states.store.set(user_id, f'awaiting_quantity_{burger_id}_1')
 
         await bot.send_message(
-            callback_query.message.chat.id,
-            f'{text}\n\nВыберите количество бургеров:',
-            reply_markup=builder.as_markup()
+            chat_id,
+            f'{burger_text(burger)}\n\nВыберите количество бургеров:',
+            reply_markup=keyboards.cache.quantity(burger_id, 1)
         )
     else:
-        await bot.send_message(callback_query.message.chat.id, 'Бургер не найден.')
+        await bot.send_message(chat_id, 'Бургер не найден.')
 
 
-@dp.callback_query(F.data.startswith('increase_'))
-async def increase_quantity(callback_query: types.CallbackQuery):
+@dp.callback_query(callbacks.QuantityCallback.filter(F.action == 'increase'))
+async def increase_quantity(callback_query: types.CallbackQuery, callback_data: callbacks.QuantityCallback):
     await bot.answer_callback_query(callback_query.id)
-    burger_id = int(callback_query.data.split('_')[1])
-    user_id = callback_query.from_user.id
-    state = await database.async_get_user_state(user_id)
-
-    if state and state.startswith('awaiting_quantity_'):
-        current_quantity = int(state.split('_')[3])
-        new_quantity = current_quantity + 1
-        await database.async_save_user_state(user_id, f'awaiting_quantity_{burger_id}_{new_quantity}')
-
-        builder = InlineKeyboardBuilder()
-        builder.row(
-            InlineKeyboardButton(text='-', callback_data=f'decrease_{burger_id}'),
-            InlineKeyboardButton(text=str(new_quantity), callback_data=f'quantity_{burger_id}_{new_quantity}'),
-            InlineKeyboardButton(text='+', callback_data=f'increase_{burger_id}')
-        )
-        builder.row(
-            InlineKeyboardButton(text='Добавить в корзину', callback_data=f'add_to_cart_{burger_id}')
-        )
 
-        await bot.edit_message_reply_markup(
-            chat_id=callback_query.message.chat.id,
-            message_id=callback_query.message.message_id,
-            reply_markup=builder.as_markup()
-        )
+    if callback_data.is_valid():
+        update_quantity(callback_query, callback_data, 1)
 
 
-@dp.callback_query(F.data.startswith('decrease_'))
-async def decrease_quantity(callback_query: types.CallbackQuery):
+@dp.callback_query(callbacks.QuantityCallback.filter(F.action == 'decrease'))
+async def decrease_quantity(callback_query: types.CallbackQuery, callback_data: callbacks.QuantityCallback):
     await bot.answer_callback_query(callback_query.id)
-    burger_id = int(callback_query.data.split('_')[1])
-    user_id = callback_query.from_user.id
-    state = await database.async_get_user_state(user_id)
-
-    if state and state.startswith('awaiting_quantity_'):
-        current_quantity = int(state.split('_')[3])
-        new_quantity = max(current_quantity - 1, 1)
-        await database.async_save_user_state(user_id, f'awaiting_quantity_{burger_id}_{new_quantity}')
-
-        builder = InlineKeyboardBuilder()
-        builder.row(
-            InlineKeyboardButton(text='-', callback_data=f'decrease_{burger_id}'),
-            InlineKeyboardButton(text=str(new_quantity), callback_data=f'quantity_{burger_id}_{new_quantity}'),
-            InlineKeyboardButton(text='+', callback_data=f'increase_{burger_id}')
-        )
-        builder.row(
-            InlineKeyboardButton(text='Добавить в корзину', callback_data=f'add_to_cart_{burger_id}')
-        )
 
-        await bot.edit_message_reply_markup(
-            chat_id=callback_query.message.chat.id,
-            message_id=callback_query.message.message_id,
-            reply_markup=builder.as_markup()
-        )
+    if callback_data.is_valid():
+        update_quantity(callback_query, callback_data, -1)
+
+
+def update_quantity(callback_query: types.CallbackQuery, callback_data: callbacks.QuantityCallback, delta):
+    if callback_query.message is None:
+        return
+
+    quantities.stepper.step(bot, callback_query.message.chat.id, callback_query.message.message_id,
+                            callback_query.from_user.id, callback_data.burger_id, callback_data.quantity, delta)
 
 
-@dp.callback_query(F.data.startswith('add_to_cart_'))
-async def add_to_cart(callback_query: types.CallbackQuery):
+@dp.callback_query(callbacks.QuantityCallback.filter(F.action == 'add'))
+async def add_to_cart(callback_query: types.CallbackQuery, callback_data: callbacks.QuantityCallback):
     await bot.answer_callback_query(callback_query.id)
-    data_parts = callback_query.data.split('_')
 
-    try:
-        burger_id = int(data_parts[3])
-    except (IndexError, ValueError):
+    if not callback_data.is_valid():
         await bot.send_message(callback_query.message.chat.id, 'Ошибка: некорректные данные.')
         return
 
     user_id = callback_query.from_user.id
-    state = await database.async_get_user_state(user_id)
-
-    if state and state.startswith('awaiting_quantity_'):
-        try:
-            quantity = int(state.split('_')[3])
-        except ValueError:
-            await bot.send_message(callback_query.message.chat.id, 'Ошибка: некорректное количество.')
-            return
+    burger_id = callback_data.burger_id
+    chat_id = callback_query.message.chat.id
+    message_id = callback_query.message.message_id
+    quantity = quantities.stepper.claim(chat_id, message_id, burger_id, callback_data.quantity)
+    if quantity is None:
+        return
 
-        await database.async_add_to_cart(user_id, burger_id, quantity)
-        await bot.send_message(callback_query.message.chat.id, f'Добавлено {quantity} бургера(-ов) в корзину!')
-        await database.async_save_user_state(user_id, 'start')
-        await bot.send_message(callback_query.message.chat.id, 'Доступные команды:\n' + '\n'.join(commands))
+    await database.async_add_to_cart(user_id, burger_id, quantity)
+    carts.cache.added(user_id, burger_id, quantity)
+    try:
+        await bot.edit_message_reply_markup(chat_id=chat_id, message_id=message_id, reply_markup=None)
+    except TelegramBadRequest as e:
+        logger.warning('Не удалось убрать клавиатуру после добавления в корзину: %s', e)
+    await states.store.set(user_id, 'start')
+    await sender.together(
+        bot.send_message(chat_id, f'Добавлено {quantity} бургера(-ов) в корзину!'),
+        bot.send_message(chat_id, 'Доступные команды:\n' + '\n'.join(commands))
+    )
 
 
 @dp.message(Command("cart"))
 async def view_cart(message: types.Message):
-    user_id = message.from_user.id
-    cart_items = await database.async_get_cart(user_id)
+    cart = await carts.cache.get(message.from_user.id)
 
-    if not cart_items:
+    if not cart.items:
         await message.answer("🛒 Ваша корзина пуста")
         return
 
-    total_stars = sum(item[4] for item in cart_items)
-    cart_text = "🛒 *Ваша корзина:*\n\n"
-
-    for item in cart_items:
-        cart_text += f"🍔 {item[1]} × {item[4]}\n"
-
-    cart_text += f"\n**Итого к оплате:** {total_stars} ★"
-
-    keyboard = InlineKeyboardBuilder()
-    keyboard.button(text="Оплатить Stars", callback_data="buy")
-    keyboard.button(text="Удалить позиции", callback_data="clear_cart")
-
     await message.answer(
-        cart_text,
-        reply_markup=keyboard.as_markup(),
+        cart.text,
+        reply_markup=keyboards.cache.cart(),
         parse_mode="Markdown"
     )
 
@@ -223,9 +229,9 @@ async def buy(callback_query: types.CallbackQuery):
 
 async def send_invoice(callback_query: types.CallbackQuery):
     user_id = callback_query.from_user.id
-    cart_items = await database.async_get_cart(user_id)
+    cart = await carts.cache.get(user_id)
 
-    if not cart_items:
+    if not cart.items:
         await bot.edit_message_text(
             'Ваша корзина пуста.',
             chat_id=callback_query.message.chat.id,
@@ -233,18 +239,17 @@ async def send_invoice(callback_query: types.CallbackQuery):
         )
         return
 
-    total_stars = sum(item[4] for item in cart_items)
-
     try:
+        snapshot = await invoices.store.create(user_id, cart.items)
         await bot.send_invoice(
             chat_id=callback_query.message.chat.id,
             title='Оплата заказа',
-            description=f'Оплата {total_stars} ★ за бургеры',
+            description=f'Оплата {snapshot.total} ★ за бургеры',
             provider_token="",
             currency='XTR',
-            prices=[LabeledPrice(label='Бургеры', amount=total_stars)],
-            payload='burgers-payment',
-            reply_markup=stars_payment_keyboard()
+            prices=[LabeledPrice(label='Бургеры', amount=snapshot.total)],
+            payload=snapshot.payload,
+            reply_markup=keyboards.cache.payment()
         )
     except Exception as e:
         logging.error(f"Ошибка при отправке инвойса: {e}")
@@ -256,7 +261,14 @@ async def send_invoice(callback_query: types.CallbackQuery):
 
 @dp.pre_checkout_query()
 async def process_pre_checkout(pre_checkout_query: types.PreCheckoutQuery):
-    await bot.answer_pre_checkout_query(pre_checkout_query.id, ok=True)
+    error = await invoices.store.validate(pre_checkout_query.from_user.id,
+                                          pre_checkout_query.invoice_payload,
+                                          pre_checkout_query.total_amount,
+                                          pre_checkout_query.currency)
+    if error:
+        await bot.answer_pre_checkout_query(pre_checkout_query.id, ok=False, error_message=error)
+    else:
+        await bot.answer_pre_checkout_query(pre_checkout_query.id, ok=True)
 
 
 @dp.message(F.successful_payment)
@@ -264,18 +276,20 @@ async def process_successful_payment(message: types.Message):
     user_id = message.from_user.id
     payment_info = message.successful_payment
 
-    async with aiosqlite.connect('burgers.db') as db:  
-        await db.execute('''
-            INSERT INTO payments (user_id, payment_id, amount, currency)
-            VALUES (?, ?, ?, ?)
-        ''', (user_id,
-              payment_info.provider_payment_charge_id,
-              payment_info.total_amount,
-              payment_info.currency))
-        await db.commit()
+    order_id = await orders.queue.submit(user_id,
+                                         payment_info.telegram_payment_charge_id,
+                                         payment_info.provider_payment_charge_id,
+                                         payment_info.total_amount,
+                                         payment_info.currency,
+                                         payment_info.invoice_payload)
+    invoices.store.forget(payment_info.invoice_payload)
+    if order_id is None:
+        logger.info('Повторное уведомление об оплате %s', payment_info.telegram_payment_charge_id)
+        return
+    carts.cache.cleared(user_id)
 
-    await database.async_clear_cart(user_id)
-    await message.answer(f"✅ Оплата прошла успешно! Спасибо за покупку {payment_info.total_amount} ★!")
+    with sender.priority(sender.PAYMENT):
+        await message.answer(f"✅ Оплата прошла успешно! Спасибо за покупку {payment_info.total_amount} ★!")
 
 
 @dp.callback_query(F.data == "clear_cart")
@@ -283,6 +297,7 @@ async def clear_cart(callback_query: types.CallbackQuery):
     await bot.answer_callback_query(callback_query.id)
     user_id = callback_query.from_user.id
     await database.async_clear_cart(user_id)
+    carts.cache.cleared(user_id)
     await bot.send_message(callback_query.message.chat.id, "Корзина успешно очищена!")
 
 
@@ -294,8 +309,7 @@ async def delete_burger(callback_query: types.CallbackQuery):
     if len(data_parts) == 2 and data_parts[0] == 'delete' and data_parts[1].isdigit():
         burger_id = int(data_parts[1])
         user_id = callback_query.from_user.id
-        cart_items = await database.async_get_cart(user_id)
-        burger = next((b for b in cart_items if b[0] == burger_id), None)
+        burger = (await carts.cache.get(user_id)).line(burger_id)
 
         if burger:
             quantity = burger[4]
@@ -330,20 +344,22 @@ async def remove_burger(callback_query: types.CallbackQuery):
         burger_id = int(data_parts[1])
         quantity_to_remove = int(data_parts[2])
         user_id = callback_query.from_user.id
-        cart_items = await database.async_get_cart(user_id)
-        burger = next((b for b in cart_items if b[0] == burger_id), None)
+        burger = (await carts.cache.get(user_id)).line(burger_id)
 
         if burger:
             quantity = burger[4]
             if 0 < quantity_to_remove <= quantity:
                 await database.async_remove_from_cart(user_id, burger_id, quantity_to_remove)
-                await bot.send_message(
-                    chat_id=callback_query.message.chat.id,
-                    text=f'Удалено {quantity_to_remove} бургера(-ов) {burger[1]}.'
-                )
-                await bot.send_message(
-                    callback_query.message.chat.id,
-                    'Доступные команды:\n' + '\n'.join(commands)
+                carts.cache.removed(user_id, burger_id, quantity_to_remove)
+                await sender.together(
+                    bot.send_message(
+                        chat_id=callback_query.message.chat.id,
+                        text=f'Удалено {quantity_to_remove} бургера(-ов) {burger[1]}.'
+                    ),
+                    bot.send_message(
+                        callback_query.message.chat.id,
+                        'Доступные команды:\n' + '\n'.join(commands)
+                    )
                 )
             else:
                 await bot.send_message(
@@ -362,21 +378,69 @@ async def remove_burger(callback_query: types.CallbackQuery):
         )
 
 
-async def main():
-    await dp.start_polling(bot)
+async def warm_caches():
+    await catalog.menu.load()
+    await keyboards.cache.warm()
 
 
-async def shutdown():
-    await bot.close()
-    await asyncio.sleep(0.1)
+async def warm_api():
+    # Первый запрос открывает соединение с Bot API - пусть это случится до первого пользователя
+    try:
+        await bot.get_me()
+    except Exception as e:
+        logger.warning('Не удалось прогреть соединение с Bot API: %s', e)
+
+
+async def startup():
+    stalls.monitor.start()
+    await metrics.start_server()
+    await database.open_storage()
+    await asyncio.gather(warm_caches(), warm_api())
+    states.store.start()
+    orders.queue.start()
+    invoices.store.start()
+    maintenance.jobs.start()
+    await broadcast.engine.resume(bot)
+
+
+async def main():
+    await database.async_init_db()
+    try:
+        # Если запуск оборвётся на полпути, shutdown закроет уже открытое: каждый компонент
+        # переносит остановку без запуска, а потоки соединений с базой иначе не дадут процессу завершиться
+        await startup()
+        lifecycle.set_ready(True)
+        if config.BOT_MODE == 'webhook':
+            await webhook.run_webhook(bot, dp)
+        else:
+            # Сессию закрываем сами в shutdown: она нужна, пока дорабатывают обработчики и очередь отправки
+            await dp.start_polling(bot, close_bot_session=False)
+    finally:
+        lifecycle.set_ready(False)
+        await shutdown()
 
 
-def atexit_handler():
-    loop = asyncio.get_event_loop()
-    loop.run_until_complete(shutdown())
+async def shutdown():
+    deadline = lifecycle.Deadline(config.SHUTDOWN_TIMEOUT)
+    await lifecycle.inflight.drain(deadline.remaining)
+    await broadcast.engine.stop(timeout=deadline.remaining)
+    await quantities.stepper.stop()
+    await maintenance.jobs.stop()
+    await invoices.store.stop()
+    # Очередь платежей дописываем без ограничения по времени: оплаченный заказ терять нельзя
+    await orders.queue.stop()
+    await states.store.stop()
+    await sender.scheduler.close(timeout=deadline.remaining)
+    await database.close_storage()
+    await bot.session.close()
+    await metrics.stop_server()
+    stalls.monitor.stop()
 
 
 if __name__ == '__main__':
-    database.init_db()
-    atexit.register(atexit_handler)
-    asyncio.run(main())
+    if config.WORKERS > 1:
+        # Миграции - один раз в родительском процессе, до запуска воркеров
+        database.init_db()
+        sharding.run(bot, dp, startup, shutdown, config.WORKERS)
+    else:
+        asyncio.run(main())
@@ -0,0 +1,150 @@
+import asyncio
+import logging
+import time
+from collections import deque
+
+from aiogram.exceptions import TelegramAPIError, TelegramForbiddenError
+
+import config
+import database
+import metrics
+import sender
+import sharding
+import states
+
+logger = logging.getLogger(__name__)
+
+messages = metrics.Counter('bot_broadcast_messages_total', 'Сообщения рассылок по результату', ('result',))
+
+
+def format_stats(row):
+    broadcast_id, _, status, _, sent, failed, blocked, created_at, finished_at = row
+    elapsed = (finished_at or int(time.time())) - created_at
+    title = {'running': 'идёт', 'done': 'завершена', 'cancelled': 'остановлена'}.get(status, status)
+    return (f'Рассылка {broadcast_id} {title}.\n'
+            f'Доставлено: {sent}\n'
+            f'Заблокировали бота (удалены): {blocked}\n'
+            f'Ошибки: {failed}\n'
+            f'Время: {elapsed // 60} мин {elapsed % 60} с, {(sent + failed + blocked) / max(elapsed, 1):.1f} сообщ./с')
+
+
+class Broadcaster:
+    def __init__(self, chunk=config.BROADCAST_CHUNK, concurrency=config.BROADCAST_CONCURRENCY,
+                 rate=config.BROADCAST_RATE):
+        self.chunk = chunk
+        self.concurrency = concurrency
+        self._bucket = sender.TokenBucket(rate, 1)
+        self._task = None
+        self._stopping = False
+        self.current = None
+
+    @property
+    def running(self):
+        return self._task is not None
+
+    def _launch(self, bot, broadcast_id, text, after):
+        self.current = broadcast_id
+        self._stopping = False
+        self._task = asyncio.create_task(self._run(bot, broadcast_id, text, after))
+
+    async def start(self, bot, text):
+        if self.running:
+            return None
+        broadcast_id = await database.async_create_broadcast(text)
+        self._launch(bot, broadcast_id, text, 0)
+        return broadcast_id
+
+    async def resume(self, bot):
+        # При нескольких воркерах рассылку ведёт тот, кому достаются команды администратора
+        if self.running or not sharding.owns(config.ADMIN_USER_ID):
+            return
+        rows = await database.async_get_broadcasts('running')
+        if rows:
+            broadcast_id, text, _, after = rows[0][:4]
+            logger.info('Продолжаем рассылку %d с user_id %d', broadcast_id, after)
+            self._launch(bot, broadcast_id, text, after)
+
+    async def _send(self, bot, text, user_id, stats, blocked):
+        while delay := self._bucket.take():
+            await asyncio.sleep(delay)
+        try:
+            await bot.send_message(user_id, text)
+        except TelegramForbiddenError:
+            blocked.append(user_id)
+            result = 'blocked'
+        except TelegramAPIError as e:
+            logger.debug('Не удалось отправить рассылку пользователю %d: %s', user_id, e)
+            result = 'failed'
+        else:
+            result = 'sent'
+        stats[result] = stats.get(result, 0) + 1
+        messages.inc(result)
+
+    async def _send_chunk(self, bot, text, recipients, stats, blocked):
+        queue = deque(recipients)
+
+        async def worker():
+            while queue and not self._stopping:
+                await self._send(bot, text, queue.popleft(), stats, blocked)
+
+        await asyncio.gather(*(worker() for _ in range(min(self.concurrency, len(recipients)))))
+        # Получатели берутся строго по порядку и каждый взятый дослан, поэтому обработан префикс пачки
+        return len(recipients) - len(queue)
+
+    async def _run(self, bot, broadcast_id, text, after):
+        try:
+            with sender.priority(sender.BULK):
+                while not self._stopping:
+                    recipients = await database.async_broadcast_recipients(after, self.chunk)
+                    if not recipients:
+                        break
+                    stats = {}
+                    blocked = []
+                    done = await self._send_chunk(bot, text, recipients, stats, blocked)
+                    if not done:
+                        break
+                    after = recipients[done - 1]
+                    # Сначала убираем заблокировавших из кэша состояний: иначе отложенная запись вернёт их строки
+                    await states.store.forget(blocked)
+                    await database.async_save_broadcast_progress(
+                        broadcast_id, after, stats.get('sent', 0), stats.get('failed', 0), blocked)
+
+            # При остановке бота рассылка остаётся незавершённой и продолжится после запуска
+            if self._stopping:
+                return
+            await database.async_finish_broadcast(broadcast_id, 'done')
+            row = await database.async_get_broadcast(broadcast_id)
+            logger.info('Рассылка %d завершена: доставлено %d, заблокировали %d, ошибок %d',
+                        broadcast_id, row[4], row[6], row[5],
+                        extra={'broadcast_id': broadcast_id, 'sent': row[4], 'blocked': row[6], 'failed': row[5]})
+            if config.ADMIN_USER_ID:
+                await bot.send_message(config.ADMIN_USER_ID, format_stats(row))
+        except Exception:
+            logger.exception('Рассылка %d прервана', broadcast_id)
+        finally:
+            self._task = None
+            self.current = None
+
+    async def cancel(self):
+        if not self.running:
+            return False
+        await database.async_finish_broadcast(self.current, 'cancelled')
+        await self.stop()
+        return True
+
+    async def stop(self, timeout=None):
+        # Даём досылаемым сообщениям завершиться, чтобы сохранённый прогресс был точным
+        task = self._task
+        if task is None:
+            return
+        self._stopping = True
+        done, _ = await asyncio.wait({task}, timeout=timeout)
+        if not done:
+            task.cancel()
+            try:
+                await task
+            except asyncio.CancelledError:
+                pass
+
+
+engine = Broadcaster()
@@ -0,0 +1,32 @@
+import hashlib
+import hmac
+
+from aiogram.filters.callback_data import CallbackData
+
+import config
+
+_SECRET = hashlib.sha256(('callback:' + (config.CALLBACK_SECRET or config.TOKEN)).encode()).digest()
+
+
+def sign(*values):
+    message = ':'.join(str(value) for value in values).encode()
+    return hmac.new(_SECRET, message, hashlib.sha256).hexdigest()[:config.CALLBACK_SIGNATURE_LENGTH]
+
+
+class QuantityCallback(CallbackData, prefix='qty'):
+    action: str
+    burger_id: int
+    quantity: int
+    sig: str
+
+    @classmethod
+    def signed(cls, action, burger_id, quantity):
+        return cls(action=action, burger_id=burger_id, quantity=quantity, sig=sign(burger_id, quantity))
+
+    def is_valid(self):
+        return self.quantity >= 1 and hmac.compare_digest(self.sig, sign(self.burger_id, self.quantity))
+
+
+class MenuPage(CallbackData, prefix='menu'):
+    direction: str
+    cursor: int
@@ -0,0 +1,109 @@
+import time
+from collections import OrderedDict
+
+import catalog
+import config
+import database
+
+DAY = 24 * 60 * 60
+
+
+class CartSummary:
+    __slots__ = ('quantities', 'updated_at', 'version', 'items', 'total', 'text')
+
+    def __init__(self, quantities, updated_at=None):
+        self.quantities = quantities
+        # Время последнего изменения корзины в базе; None - корзина пуста
+        self.updated_at = updated_at
+        self.version = None
+        self.items = ()
+        self.total = 0
+        self.text = ''
+
+    def stale(self, before):
+        return self.updated_at is not None and self.updated_at < before
+
+    def line(self, burger_id):
+        for item in self.items:
+            if item[0] == burger_id:
+                return item
+        return None
+
+
+def render(items, total):
+    lines = ['🛒 *Ваша корзина:*\n']
+    lines.extend(f'🍔 {item[1]} × {item[4]}' for item in items)
+    lines.append(f'\n**Итого к оплате:** {total} ★')
+    return '\n'.join(lines)
+
+
+class CartCache:
+    # В памяти - только количества; названия и цены берутся из каталога, поэтому правки меню
+    # сразу видны в корзине, а позиции и текст пересобираются лишь при изменении корзины или каталога
+    def __init__(self, menu=catalog.menu, size=config.CART_CACHE_SIZE, retention=config.CART_RETENTION_DAYS * DAY):
+        self.menu = menu
+        self.size = size
+        self.retention = retention
+        self._summaries = OrderedDict()
+
+    async def get(self, user_id):
+        summary = self._summaries.get(user_id)
+        # Корзину старше срока хранения могло удалить обслуживание - в том числе в другом воркере,
+        # до кэша которого forget не дотягивается. Такую корзину перечитываем, пока её не удалят или не изменят
+        if summary is not None and summary.stale(time.time() - self.retention):
+            del self._summaries[user_id]
+            summary = None
+        if summary is None:
+            rows = await database.async_get_cart(user_id)
+            summary = self._summaries[user_id] = CartSummary({row[0]: row[4] for row in rows},
+                                                             max((row[5] for row in rows), default=None))
+            if len(self._summaries) > self.size:
+                self._summaries.popitem(last=False)
+        else:
+            self._summaries.move_to_end(user_id)
+
+        await self.menu.refresh()
+        version = self.menu.version
+        if summary.version != version:
+            items = []
+            for burger_id in sorted(summary.quantities):
+                burger = await self.menu.get(burger_id)
+                if burger is not None:
+                    items.append((burger[0], burger[1], burger[2], burger[3], summary.quantities[burger_id]))
+            summary.items = tuple(items)
+            summary.total = sum(item[3] * item[4] for item in items)
+            summary.text = render(items, summary.total) if items else ''
+            summary.version = version
+        return summary
+
+    def _change(self, user_id, burger_id, delta):
+        # Корзины, которых нет в памяти, не трогаем: их прочитают из базы при следующем обращении
+        summary = self._summaries.get(user_id)
+        if summary is None:
+            return
+        quantity = summary.quantities.get(burger_id, 0) + delta
+        if quantity > 0:
+            summary.quantities[burger_id] = quantity
+        else:
+            summary.quantities.pop(burger_id, None)
+        summary.updated_at = int(time.time()) if summary.quantities else None
+        summary.version = None
+
+    def added(self, user_id, burger_id, quantity):
+        self._change(user_id, burger_id, quantity)
+
+    def removed(self, user_id, burger_id, quantity):
+        self._change(user_id, burger_id, -quantity)
+
+    def cleared(self, user_id):
+        self._summaries[user_id] = CartSummary({})
+        self._summaries.move_to_end(user_id)
+        if len(self._summaries) > self.size:
+            self._summaries.popitem(last=False)
+
+    def forget(self, user_ids):
+        for user_id in user_ids:
+            self._summaries.pop(user_id, None)
+
+
+cache = CartCache()
@@ -0,0 +1,74 @@
+import asyncio
+import bisect
+import time
+
+import config
+import database
+
+
+class Catalog:
+    def __init__(self, ttl=config.CATALOG_TTL):
+        self.ttl = ttl
+        self.version = 0
+        self.burgers = ()
+        self._ids = []
+        self._by_id = {}
+        self._generation = 0
+        self._loaded_generation = -1
+        self._catalog_version = None
+        self._checked_at = 0.0
+        self._lock = asyncio.Lock()
+
+    def invalidate(self):
+        self._generation += 1
+
+    async def load(self):
+        async with self._lock:
+            await self._load()
+
+    async def _load(self):
+        generation = self._generation
+        # Версию читаем до данных: изменение во время загрузки вызовет повторную загрузку
+        catalog_version = await database.async_get_catalog_version()
+        burgers = tuple(await database.async_get_burgers())
+
+        self.burgers = burgers
+        self._ids = [burger[0] for burger in burgers]
+        self._by_id = {burger[0]: burger for burger in burgers}
+        self.version += 1
+        self._catalog_version = catalog_version
+        self._checked_at = time.monotonic()
+        self._loaded_generation = generation
+
+    async def refresh(self):
+        if self._loaded_generation != self._generation:
+            async with self._lock:
+                # Пока ждали блокировку, каталог мог уже перезагрузить другой запрос
+                if self._loaded_generation != self._generation:
+                    await self._load()
+            return
+
+        if self.ttl and time.monotonic() - self._checked_at >= self.ttl:
+            self._checked_at = time.monotonic()
+            catalog_version = await database.async_get_catalog_version()
+            if catalog_version != self._catalog_version:
+                async with self._lock:
+                    if catalog_version != self._catalog_version:
+                        await self._load()
+
+    async def get_page(self, cursor=0, forward=True, size=config.MENU_PAGE_SIZE):
+        # Страница задаётся не номером, а id соседнего бургера, поэтому не съезжает при изменении меню
+        await self.refresh()
+        if forward:
+            start = bisect.bisect_right(self._ids, cursor)
+        else:
+            start = max(bisect.bisect_left(self._ids, cursor) - size, 0)
+        return self.burgers[start:start + size], start > 0, start + size < len(self.burgers)
+
+    async def get(self, burger_id):
+        await self.refresh()
+        return self._by_id.get(burger_id)
+
+
+menu = Catalog()
+database.add_catalog_listener(menu.invalidate)
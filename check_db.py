@@ -0,0 +1,96 @@
+import asyncio
+import json
+import os
+import sqlite3
+import tempfile
+
+import database
+
+USER_ID = 1001
+OTHER_USER_ID = 1002
+CHARGE_ID = 'charge-1'
+
+
+def expect(actual, expected, what):
+    if actual != expected:
+        raise SystemExit(f'ОШИБКА: {what}: ожидалось {expected!r}, получено {actual!r}')
+    print(f'ок: {what}')
+
+
+def create_baseline(path):
+    # База в том виде, в каком её оставлял исходный init_db: корзина без ключа, с дублями строк
+    with sqlite3.connect(path) as conn:
+        conn.executescript(database.MIGRATIONS[0])
+        conn.executemany('INSERT INTO burgers (name, description, price) VALUES (?, ?, ?)',
+                         [('Классический', 'Говядина и сыр', 5), ('Двойной', 'Две котлеты', 8)])
+        conn.executemany('INSERT INTO cart (user_id, burger_id, quantity) VALUES (?, ?, ?)',
+                         [(USER_ID, 1, 1), (USER_ID, 1, 2), (USER_ID, 2, 1), (OTHER_USER_ID, 2, 4)])
+        conn.execute('INSERT INTO payments (user_id, payment_id, amount, currency) VALUES (?, ?, ?, ?)',
+                     (OTHER_USER_ID, 'old-charge', 32, 'XTR'))
+        conn.execute('INSERT INTO user_states (user_id, state) VALUES (?, ?)', (OTHER_USER_ID, '{}'))
+    conn.close()
+
+
+async def count(sql, *args):
+    async with database.pool.reader() as db:
+        return (await db.execute_fetchall(sql, args))[0][0]
+
+
+async def check_migrations():
+    await database.async_init_db()
+    expect(await database.async_get_schema_version(), len(database.MIGRATIONS), 'версия схемы после миграций')
+
+    cart = await database.async_get_cart(USER_ID)
+    expect(sorted((row[0], row[4]) for row in cart), [(1, 3), (2, 1)], 'дубли корзины слиты по (user_id, burger_id)')
+    expect(await count('SELECT COUNT(*) FROM payments'), 1, 'старые платежи сохранены')
+    expect(await count('SELECT COUNT(*) FROM users'), 1, 'пользователи перенесены в users')
+
+    await database.async_add_to_cart(USER_ID, 1, 2)
+    expect(await count('SELECT quantity FROM cart WHERE user_id = ? AND burger_id = 1', USER_ID), 5,
+           'повторное добавление увеличивает количество')
+
+    # Повторный запуск не должен ничего менять
+    await database.async_init_db()
+    expect(await database.async_get_schema_version(), len(database.MIGRATIONS), 'повторный запуск миграций')
+
+
+async def check_duplicate_charge():
+    items = json.dumps([(1, 'Классический', 5, 5), (2, 'Двойной', 8, 1)])
+    await database.async_save_invoice('payload-1', USER_ID, 'hash', 33, items, 2 ** 31)
+    payment = (USER_ID, CHARGE_ID, 'provider-1', 33, 'XTR', 'payload-1')
+
+    # Telegram может прислать то же уведомление об оплате дважды - и в одной пачке, и позже
+    first = await database.async_record_orders([payment, payment])
+    second = await database.async_record_orders([payment])
+    expect(isinstance(first[0], int), True, 'первое уведомление оформляет заказ')
+    expect([first[1], second[0]], [None, None], 'повторы распознаны как уже оформленные')
+
+    expect(await count('SELECT COUNT(*) FROM orders WHERE charge_id = ?', CHARGE_ID), 1, 'один заказ на charge_id')
+    expect(await count('SELECT COUNT(*) FROM payments WHERE payment_id = ?', CHARGE_ID), 1, 'один платёж на charge_id')
+    expect(await count('SELECT COUNT(*) FROM order_items WHERE order_id = ?', first[0]), 2, 'состав заказа из счёта')
+    expect(await count('SELECT SUM(orders) FROM sales_hourly'), 1, 'заказ учтён в сводке один раз')
+    expect(await count('SELECT SUM(quantity) FROM burger_sales_hourly'), 6, 'бургеры учтены в сводке один раз')
+    expect(await count('SELECT COUNT(*) FROM cart WHERE user_id = ?', USER_ID), 0, 'корзина очищена')
+
+
+async def run(path):
+    database.configure(path)
+    await database.open_storage()
+    try:
+        await check_migrations()
+        await check_duplicate_charge()
+    finally:
+        await database.close_storage()
+
+
+def main():
+    # Проверка миграций исходной базы и идемпотентности оплаты на временном файле
+    with tempfile.TemporaryDirectory(prefix='burgers-check-') as workdir:
+        path = os.path.join(workdir, 'burgers.db')
+        create_baseline(path)
+        asyncio.run(run(path))
+    print('Все проверки пройдены')
+
+
+if __name__ == '__main__':
+    main()
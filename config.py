@@ -1,4 +1,103 @@
 TOKEN = ''
-ADMIN_USER_ID = 
+ADMIN_USER_ID = 0
+# ':memory:' или 'memory:имя' - база в памяти процесса, только для тестов и бенчмарков:
+# читатели в ней видят незафиксированные изменения писателя (read_uncommitted)
 DATABASE_PATH = 'burgers.db'
 GITLAB_ACCESS_TOKEN = ''
+
+# Как часто (в секундах) проверять, не изменил ли меню другой процесс
+CATALOG_TTL = 30
+
+# Кэш состояний пользователей: размер LRU, период (в секундах) и размер пачки отложенной записи
+STATE_CACHE_SIZE = 10000
+STATE_FLUSH_INTERVAL = 0.5
+STATE_FLUSH_BATCH = 500
+
+# Ключ подписи callback_data (по умолчанию выводится из TOKEN) и длина подписи в hex-символах
+CALLBACK_SECRET = ''
+CALLBACK_SIGNATURE_LENGTH = 12
+
+# Режим получения обновлений: 'polling' или 'webhook'
+BOT_MODE = 'polling'
+WEBHOOK_HOST = '0.0.0.0'
+WEBHOOK_PORT = 8080
+WEBHOOK_PATH = '/webhook'
+# Публичный адрес, по которому Telegram достучится до бота (без пути); пусто - webhook не регистрируется
+WEBHOOK_URL = ''
+WEBHOOK_SECRET = ''
+
+# Сколько секунд при остановке ждать обработчиков и отправки сообщений из очереди
+SHUTDOWN_TIMEOUT = 10
+
+# Число процессов-воркеров; при WORKERS > 1 пользователи распределяются между ними по user_id
+WORKERS = 1
+
+# Ограничения исходящих запросов к Bot API (сообщений в секунду)
+SEND_GLOBAL_RATE = 30
+SEND_CHAT_RATE = 1
+SEND_CHAT_BURST = 3
+SEND_GROUP_RATE = 20 / 60
+SEND_MAX_RETRIES = 3
+
+# Сколько платежей из очереди записывать одной транзакцией
+ORDER_BATCH_SIZE = 50
+
+# Сколько секунд действителен выставленный счёт и как часто удалять просроченные
+INVOICE_TTL = 3600
+INVOICE_CLEANUP_INTERVAL = 600
+
+# Порт локального эндпоинта /metrics (0 - не поднимать); в режиме WORKERS > 1 воркер i слушает порт + i + 1
+METRICS_HOST = '127.0.0.1'
+METRICS_PORT = 9090
+# Запросы к базе дольше этого порога (в миллисекундах) попадают в лог
+SLOW_QUERY_MS = 50
+
+# Логирование: формат 'text' или 'json', доля сохраняемых записей уровня INFO и ниже,
+# и сколько одинаковых предупреждений пропускать за интервал (в секундах), остальные подавляются
+LOG_LEVEL = 'INFO'
+LOG_FORMAT = 'text'
+LOG_SAMPLE_RATE = 1.0
+LOG_REPEAT_LIMIT = 10
+LOG_REPEAT_INTERVAL = 60
+
+# Сколько готовых клавиатур выбора количества держать в памяти
+KEYBOARD_CACHE_SIZE = 4096
+
+# Сколько сводок корзин (позиции, итог и готовый текст) держать в памяти
+CART_CACHE_SIZE = 10000
+
+# Бургеров на одной странице меню и максимум результатов в inline-поиске (ограничение Telegram - 50)
+MENU_PAGE_SIZE = 8
+INLINE_RESULTS_LIMIT = 50
+
+# Окно (в секундах), за которое серия нажатий +/- сливается в одно изменение клавиатуры,
+# и сколько сообщений с выбором количества помнить
+STEPPER_DEBOUNCE = 0.4
+STEPPER_CACHE_SIZE = 10000
+
+# Отладка: сообщать со стеком о блокировках цикла событий дольше порога (в миллисекундах); 0 - выключено
+LOOP_STALL_THRESHOLD_MS = 0
+
+# Необязательная реплика базы (копия файла, которую обновляет внешний процесс) для чтения меню и поиска
+CATALOG_REPLICA_PATH = ''
+
+# Обслуживание базы: сколько дней хранить состояния, брошенные корзины, платежи и заказы (0 - не архивировать).
+# Повтор уведомления об оплате распознаётся по заказу, поэтому срок хранения заказов - не меньше нескольких дней
+STATE_RETENTION_DAYS = 180
+CART_RETENTION_DAYS = 30
+PAYMENTS_RETENTION_DAYS = 365
+PAYMENTS_ARCHIVE_DIR = 'archive'
+# Период запуска (в секундах, 0 - выключено), размер пачки, пауза между пачками
+# и бюджет времени на одну задачу за запуск
+MAINTENANCE_INTERVAL = 3600
+MAINTENANCE_BATCH = 500
+MAINTENANCE_BATCH_PAUSE = 0.05
+MAINTENANCE_TIME_BUDGET = 5
+MAINTENANCE_VACUUM_PAGES = 1000
+MAINTENANCE_ANALYZE_LIMIT = 1000
+
+# Рассылки: получателей читаем пачками, прогресс сохраняется после каждой пачки;
+# одновременных отправок и предел сообщений в секунду - с запасом под ответы пользователям
+BROADCAST_CHUNK = 200
+BROADCAST_CONCURRENCY = 20
+BROADCAST_RATE = 20
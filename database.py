@@ -1,203 +1,950 @@
+import asyncio
+import contextvars
+import json
+import logging
+import re
 import sqlite3
+from contextlib import asynccontextmanager
+
 import aiosqlite
 
+import config
+import metrics
+
+logger = logging.getLogger(__name__)
+
+READER_POOL_SIZE = 4
+
+_catalog_listeners = []
+
+PRAGMAS = (
+    'PRAGMA synchronous = NORMAL',
+    'PRAGMA busy_timeout = 5000',
+    'PRAGMA temp_store = MEMORY',
+    'PRAGMA cache_size = -16000',
+    'PRAGMA mmap_size = 134217728',
+)
+
+
+class SQLiteStorage:
+    # Файл SQLite: один писатель и пул читателей в режиме WAL.
+    # read_only - реплика, которую обновляет кто-то другой: только чтение, без смены режима журнала
+    def __init__(self, path, readers=READER_POOL_SIZE, read_only=False):
+        self.path = path
+        self.size = readers
+        self.read_only = read_only
+        self._writer = None
+        self._readers = None
+        self._write_lock = asyncio.Lock()
+        self._open_lock = asyncio.Lock()
+
+    def clone(self, readers):
+        return type(self)(self.path, readers, self.read_only)
+
+    @property
+    def database(self):
+        return f'file:{self.path}?mode=ro' if self.read_only else self.path
+
+    def connect(self):
+        return aiosqlite.connect(self.database, uri=self.read_only, isolation_level=None)
+
+    @property
+    def is_open(self):
+        return self._writer is not None
+
+    async def _connect(self, query_only=False):
+        conn = await self.connect()
+        pragmas = PRAGMAS + ('PRAGMA query_only = ON',) if query_only else PRAGMAS
+        await conn.executescript(';'.join(pragmas))
+        return conn
+
+    async def open(self):
+        async with self._open_lock:
+            if self.is_open:
+                return
+            # У реплики "писатель" тоже открыт только на чтение
+            writer = await self._connect(query_only=self.read_only)
+            if not self.read_only:
+                await writer.execute_fetchall('PRAGMA journal_mode = WAL')
+            readers = asyncio.Queue()
+            for _ in range(self.size):
+                readers.put_nowait(await self._connect(query_only=True))
+            self._readers = readers
+            self._writer = writer
+
+    async def close(self):
+        async with self._open_lock:
+            if not self.is_open:
+                return
+            async with self._write_lock:
+                writer, self._writer = self._writer, None
+                await writer.close()
+            # Дожидаемся возврата всех читателей в пул
+            for _ in range(self.size):
+                conn = await self._readers.get()
+                await conn.close()
+            self._readers = None
+
+    @asynccontextmanager
+    async def reader(self):
+        if not self.is_open:
+            await self.open()
+        readers = self._readers
+        conn = await readers.get()
+        try:
+            yield conn
+        finally:
+            readers.put_nowait(conn)
+
+    @asynccontextmanager
+    async def writer(self):
+        if self.read_only:
+            raise RuntimeError(f'База {self.path} открыта только для чтения')
+        if not self.is_open:
+            await self.open()
+        async with self._write_lock:
+            conn = self._writer
+            await conn.execute('BEGIN IMMEDIATE')
+            try:
+                yield conn
+            except BaseException:
+                await conn.execute('ROLLBACK')
+                raise
+            await conn.execute('COMMIT')
+
+    @asynccontextmanager
+    async def autocommit(self):
+        # Писатель без открытой транзакции - для команд, которые executescript выполняет целиком
+        if self.read_only:
+            raise RuntimeError(f'База {self.path} открыта только для чтения')
+        if not self.is_open:
+            await self.open()
+        async with self._write_lock:
+            yield self._writer
+
+
+class MemoryStorage(SQLiteStorage):
+    # База в памяти с общим кэшем: для тестов и нагрузочных прогонов, живёт только в этом процессе
+    # Несколько независимых баз: 'memory:имя'
+    def __init__(self, path=':memory:', readers=READER_POOL_SIZE, anchor=None):
+        super().__init__(path, readers)
+        self.name = path.removeprefix('memory:') if path.startswith('memory:') else 'burgers'
+        # Пока открыто хотя бы одно соединение, база в памяти не исчезает
+        self._anchor = anchor or sqlite3.connect(self.database, uri=True)
+
+    def clone(self, readers):
+        return type(self)(self.path, readers, anchor=self._anchor)
+
+    @property
+    def database(self):
+        return f'file:{self.name}?mode=memory&cache=shared'
+
+    def connect(self):
+        return aiosqlite.connect(self.database, uri=True, isolation_level=None)
+
+    async def _connect(self, query_only=False):
+        conn = await super()._connect(query_only)
+        # В общем кэше блокировки табличные и busy_timeout на них не действует: без read_uncommitted
+        # читатель сразу получает "database table is locked", пока писатель держит транзакцию.
+        # Цена - грязные чтения: читатель может увидеть незафиксированные и затем откаченные строки,
+        # поэтому такая база годится только для тестов и бенчмарков, но не для работы бота
+        await conn.execute('PRAGMA read_uncommitted = ON')
+        return conn
+
+
+def is_memory_path(path):
+    return path == ':memory:' or path.startswith('memory:')
+
+
+def create_storage(path, readers=READER_POOL_SIZE, read_only=False):
+    if is_memory_path(path):
+        return MemoryStorage(path, readers)
+    return SQLiteStorage(path, readers, read_only)
+
+
+pool = create_storage(config.DATABASE_PATH)
+# Необязательная реплика для чтения каталога (меню, поиск); без неё каталог читается из основной базы
+catalog_pool = create_storage(config.CATALOG_REPLICA_PATH, read_only=True) if config.CATALOG_REPLICA_PATH else None
+# Синхронные обёртки подменяют пул на собственный, привязанный к их временному циклу событий
+_active_pool = contextvars.ContextVar('active_pool', default=None)
+
+
+def configure(path, catalog_replica_path='', read_only=False):
+    # Для скриптов и бенчмарка: сменить базу до открытия пулов
+    global pool, catalog_pool
+    pool = create_storage(path, read_only=read_only)
+    catalog_pool = create_storage(catalog_replica_path, read_only=True) if catalog_replica_path else None
+
+
+def _current_pool():
+    return _active_pool.get() or pool
+
+
+async def open_storage():
+    await pool.open()
+    if catalog_pool is not None:
+        await catalog_pool.open()
+
+
+async def close_storage():
+    if catalog_pool is not None:
+        await catalog_pool.close()
+    await pool.close()
+
+
+def _catalog_pool():
+    return _active_pool.get() or catalog_pool or pool
+
+
+def add_catalog_listener(callback):
+    _catalog_listeners.append(callback)
+
+
+def _notify_catalog_changed():
+    for callback in _catalog_listeners:
+        callback()
+
+
+# Миграции схемы: номер миграции = индекс в кортеже + 1, текущая версия хранится в PRAGMA user_version
+MIGRATIONS = (
+    # 1. Исходная схема
+    '''
+    CREATE TABLE IF NOT EXISTS burgers (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        name TEXT NOT NULL,
+        description TEXT NOT NULL,
+        price INTEGER NOT NULL DEFAULT 1
+    );
+
+    CREATE TABLE IF NOT EXISTS cart (
+        user_id INTEGER NOT NULL,
+        burger_id INTEGER NOT NULL,
+        quantity INTEGER NOT NULL DEFAULT 1,
+        FOREIGN KEY (burger_id) REFERENCES burgers (id)
+    );
+
+    CREATE TABLE IF NOT EXISTS payments (
+        user_id INTEGER,
+        payment_id TEXT,
+        amount INTEGER,
+        currency TEXT,
+        timestamp DATETIME DEFAULT CURRENT_TIMESTAMP,
+        PRIMARY KEY (user_id, payment_id)
+    );
+
+    CREATE TABLE IF NOT EXISTS user_states (
+        user_id INTEGER PRIMARY KEY,
+        state TEXT NOT NULL
+    );
+    ''',
+    # 2. Ключ (user_id, burger_id) для корзины со слиянием дублей и индексы платежей
+    '''
+    CREATE TABLE cart_new (
+        user_id INTEGER NOT NULL,
+        burger_id INTEGER NOT NULL,
+        quantity INTEGER NOT NULL DEFAULT 1,
+        PRIMARY KEY (user_id, burger_id),
+        FOREIGN KEY (burger_id) REFERENCES burgers (id)
+    ) WITHOUT ROWID;
+
+    INSERT INTO cart_new (user_id, burger_id, quantity)
+    SELECT user_id, burger_id, SUM(quantity) FROM cart GROUP BY user_id, burger_id;
+
+    DROP TABLE cart;
+    ALTER TABLE cart_new RENAME TO cart;
+
+    CREATE INDEX IF NOT EXISTS idx_payments_payment_id ON payments (payment_id);
+    CREATE INDEX IF NOT EXISTS idx_payments_timestamp ON payments (timestamp, amount);
+    ''',
+    # 3. Заказы: снимок корзины на момент оплаты, идемпотентность по telegram_payment_charge_id
+    '''
+    CREATE TABLE orders (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        user_id INTEGER NOT NULL,
+        charge_id TEXT NOT NULL UNIQUE,
+        provider_charge_id TEXT,
+        amount INTEGER NOT NULL,
+        currency TEXT NOT NULL,
+        created_at DATETIME DEFAULT CURRENT_TIMESTAMP
+    );
+
+    CREATE INDEX idx_orders_user ON orders (user_id, created_at);
+
+    CREATE TABLE order_items (
+        order_id INTEGER NOT NULL,
+        burger_id INTEGER NOT NULL,
+        name TEXT NOT NULL,
+        price INTEGER NOT NULL,
+        quantity INTEGER NOT NULL,
+        PRIMARY KEY (order_id, burger_id),
+        FOREIGN KEY (order_id) REFERENCES orders (id)
+    ) WITHOUT ROWID;
+    ''',
+    # 4. Снимки корзины для выставленных счетов
+    '''
+    CREATE TABLE invoices (
+        payload TEXT PRIMARY KEY,
+        user_id INTEGER NOT NULL,
+        cart_hash TEXT NOT NULL,
+        total INTEGER NOT NULL,
+        items TEXT NOT NULL,
+        expires_at INTEGER NOT NULL
+    ) WITHOUT ROWID;
+
+    CREATE INDEX idx_invoices_expires ON invoices (expires_at);
+    ''',
+    # 5. Полнотекстовый поиск по названию и описанию бургеров
+    '''
+    CREATE VIRTUAL TABLE burgers_fts USING fts5(
+        name, description,
+        content='burgers', content_rowid='id',
+        tokenize='unicode61 remove_diacritics 2', prefix='2 3'
+    );
+
+    CREATE TRIGGER burgers_fts_insert AFTER INSERT ON burgers BEGIN
+        INSERT INTO burgers_fts (rowid, name, description) VALUES (new.id, new.name, new.description);
+    END;
+
+    CREATE TRIGGER burgers_fts_delete AFTER DELETE ON burgers BEGIN
+        INSERT INTO burgers_fts (burgers_fts, rowid, name, description)
+        VALUES ('delete', old.id, old.name, old.description);
+    END;
+
+    CREATE TRIGGER burgers_fts_update AFTER UPDATE ON burgers BEGIN
+        INSERT INTO burgers_fts (burgers_fts, rowid, name, description)
+        VALUES ('delete', old.id, old.name, old.description);
+        INSERT INTO burgers_fts (rowid, name, description) VALUES (new.id, new.name, new.description);
+    END;
+
+    INSERT INTO burgers_fts (burgers_fts) VALUES ('rebuild');
+    ''',
+    # 6. Время последнего изменения состояний и корзин - для удаления устаревших записей
+    '''
+    ALTER TABLE user_states ADD COLUMN updated_at INTEGER NOT NULL DEFAULT 0;
+    ALTER TABLE cart ADD COLUMN updated_at INTEGER NOT NULL DEFAULT 0;
+    UPDATE user_states SET updated_at = CAST(strftime('%s', 'now') AS INTEGER);
+    UPDATE cart SET updated_at = CAST(strftime('%s', 'now') AS INTEGER);
+
+    CREATE INDEX idx_user_states_updated ON user_states (updated_at);
+    CREATE INDEX idx_cart_updated ON cart (updated_at);
+    ''',
+    # 7. Почасовые сводки продаж, которые пополняются в транзакции оплаты
+    '''
+    CREATE TABLE sales_hourly (
+        hour INTEGER NOT NULL,
+        currency TEXT NOT NULL,
+        orders INTEGER NOT NULL,
+        revenue INTEGER NOT NULL,
+        PRIMARY KEY (hour, currency)
+    ) WITHOUT ROWID;
+
+    CREATE TABLE burger_sales_hourly (
+        hour INTEGER NOT NULL,
+        burger_id INTEGER NOT NULL,
+        name TEXT NOT NULL,
+        quantity INTEGER NOT NULL,
+        revenue INTEGER NOT NULL,
+        PRIMARY KEY (hour, burger_id)
+    ) WITHOUT ROWID;
+
+    INSERT INTO sales_hourly (hour, currency, orders, revenue)
+    SELECT CAST(strftime('%s', created_at) AS INTEGER) / 3600 * 3600, currency, COUNT(*), SUM(amount)
+    FROM orders
+    GROUP BY 1, 2;
+
+    INSERT INTO burger_sales_hourly (hour, burger_id, name, quantity, revenue)
+    SELECT CAST(strftime('%s', o.created_at) AS INTEGER) / 3600 * 3600, i.burger_id, MAX(i.name),
+           SUM(i.quantity), SUM(i.price * i.quantity)
+    FROM order_items i
+    JOIN orders o ON o.id = i.order_id
+    GROUP BY 1, 2;
+    ''',
+    # 8. Рассылки: прогресс сохраняется после каждой пачки получателей
+    '''
+    CREATE TABLE broadcasts (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        text TEXT NOT NULL,
+        status TEXT NOT NULL DEFAULT 'running',
+        last_user_id INTEGER NOT NULL DEFAULT 0,
+        sent INTEGER NOT NULL DEFAULT 0,
+        failed INTEGER NOT NULL DEFAULT 0,
+        blocked INTEGER NOT NULL DEFAULT 0,
+        created_at INTEGER NOT NULL,
+        finished_at INTEGER
+    );
+    ''',
+    # 9. Счётчик изменений каталога: его проверка не зависит от записей в корзины и состояния
+    '''
+    CREATE TABLE catalog_version (
+        id INTEGER PRIMARY KEY CHECK (id = 1),
+        version INTEGER NOT NULL
+    );
+    INSERT INTO catalog_version (id, version) VALUES (1, 0);
+
+    CREATE TRIGGER burgers_version_insert AFTER INSERT ON burgers BEGIN
+        UPDATE catalog_version SET version = version + 1;
+    END;
+    CREATE TRIGGER burgers_version_delete AFTER DELETE ON burgers BEGIN
+        UPDATE catalog_version SET version = version + 1;
+    END;
+    CREATE TRIGGER burgers_version_update AFTER UPDATE ON burgers BEGIN
+        UPDATE catalog_version SET version = version + 1;
+    END;
+    ''',
+    # 10. Все известные пользователи - для рассылок; в отличие от user_states не чистится по сроку.
+    # blocked_at - когда пользователь заблокировал бота
+    '''
+    CREATE TABLE users (
+        user_id INTEGER PRIMARY KEY,
+        blocked_at INTEGER
+    );
+
+    INSERT OR IGNORE INTO users (user_id)
+    SELECT user_id FROM user_states
+    UNION SELECT user_id FROM orders
+    UNION SELECT user_id FROM payments;
+    ''',
+    # 11. Индекс для архивации старых заказов по дате
+    '''
+    CREATE INDEX idx_orders_created ON orders (created_at);
+    ''',
+)
+
+# Пользователь, снова написавший боту после блокировки, опять получает рассылки
+USER_UPSERT = '''
+    INSERT INTO users (user_id) VALUES (?)
+    ON CONFLICT (user_id) DO UPDATE SET blocked_at = NULL WHERE blocked_at IS NOT NULL
+'''
+
+NOW = "CAST(strftime('%s', 'now') AS INTEGER)"
+HOUR = f'({NOW} / 3600 * 3600)'
+
+
+async def async_get_schema_version():
+    async with _current_pool().reader() as db:
+        return (await db.execute_fetchall('PRAGMA user_version'))[0][0]
+
+
+async def async_init_db():
+    async with _current_pool().connect() as conn:
+        version = (await conn.execute_fetchall('PRAGMA user_version'))[0][0]
+
+        for number, script in enumerate(MIGRATIONS[version:], start=version + 1):
+            try:
+                await conn.executescript(f'BEGIN IMMEDIATE; {script}; PRAGMA user_version = {number}; COMMIT;')
+            except sqlite3.Error:
+                await conn.rollback()
+                raise
+            logger.info('Применена миграция базы данных %d', number)
+
+        # Режим auto_vacuum меняется только полным VACUUM - один раз, до начала работы бота
+        if (await conn.execute_fetchall('PRAGMA auto_vacuum'))[0][0] != 2:
+            await conn.executescript('PRAGMA auto_vacuum = INCREMENTAL; VACUUM;')
+            logger.info('База переведена в режим auto_vacuum = INCREMENTAL')
+
+
+CART_UPSERT = f'''
+    INSERT INTO cart (user_id, burger_id, quantity, updated_at)
+    VALUES (?, ?, ?, {NOW})
+    ON CONFLICT (user_id, burger_id) DO UPDATE SET
+        quantity = quantity + excluded.quantity,
+        updated_at = excluded.updated_at
+'''
+
+CART_DECREMENT = f'UPDATE cart SET quantity = quantity - ?, updated_at = {NOW} WHERE user_id = ? AND burger_id = ?'
+
+CART_DELETE_EMPTY = 'DELETE FROM cart WHERE user_id = ? AND burger_id = ? AND quantity <= 0'
+
+
+@metrics.timed_query
+async def async_get_burgers():
+    async with _catalog_pool().reader() as db:
+        return await db.execute_fetchall('SELECT * FROM burgers ORDER BY id')
+
+
+def _search_expression(text):
+    # Каждое слово ищем по префиксу; кавычки защищают от синтаксиса запросов FTS5
+    return ' '.join(f'"{word}"*' for word in re.findall(r'\w+', text.lower()))
+
+
+@metrics.timed_query
+async def async_search_burgers(text, limit):
+    expression = _search_expression(text)
+    if not expression:
+        return []
+    async with _catalog_pool().reader() as db:
+        return await db.execute_fetchall('''
+            SELECT b.*
+            FROM burgers_fts
+            JOIN burgers b ON b.id = burgers_fts.rowid
+            WHERE burgers_fts MATCH ?
+            ORDER BY burgers_fts.rank
+            LIMIT ?
+        ''', (expression, limit))
+
+
+@metrics.timed_query
+async def async_add_burger(name, description, price):
+    async with _current_pool().writer() as db:
+        cursor = await db.execute(
+            'INSERT INTO burgers (name, description, price) VALUES (?, ?, ?)',
+            (name, description, price)
+        )
+    _notify_catalog_changed()
+    return cursor.lastrowid
+
+
+BURGER_FIELDS = ('name', 'description', 'price')
+
+
+@metrics.timed_query
+async def async_update_burger(burger_id, field, value):
+    if field not in BURGER_FIELDS:
+        raise ValueError(f'Неизвестное поле бургера: {field}')
+    async with _current_pool().writer() as db:
+        cursor = await db.execute(f'UPDATE burgers SET {field} = ? WHERE id = ?', (value, burger_id))
+    if cursor.rowcount:
+        _notify_catalog_changed()
+    return cursor.rowcount
+
+
+@metrics.timed_query
+async def async_import_burgers(rows):
+    # rows: (id или None, name, description, price); строки с существующим id обновляются
+    async with _current_pool().writer() as db:
+        await db.executemany('''
+            INSERT INTO burgers (id, name, description, price) VALUES (?, ?, ?, ?)
+            ON CONFLICT (id) DO UPDATE SET
+                name = excluded.name,
+                description = excluded.description,
+                price = excluded.price
+        ''', rows)
+    _notify_catalog_changed()
+    return len(rows)
+
+
+@metrics.timed_query
+async def async_remove_burger(burger_id):
+    async with _current_pool().writer() as db:
+        cursor = await db.execute('DELETE FROM burgers WHERE id = ?', (burger_id,))
+    if cursor.rowcount:
+        _notify_catalog_changed()
+    return cursor.rowcount
+
+
+@metrics.timed_query
+async def async_get_catalog_version():
+    # Счётчик изменений каталога ведут триггеры, поэтому он виден из любого процесса, а читается
+    # обычным читателем - проверка не ждёт писателя, занятого импортом или архивированием
+    async with _catalog_pool().reader() as db:
+        rows = await db.execute_fetchall('SELECT version FROM catalog_version')
+        return rows[0][0]
+
+
+@metrics.timed_query
+async def async_add_to_cart(user_id, burger_id, quantity):
+    async with _current_pool().writer() as db:
+        await db.execute(CART_UPSERT, (user_id, burger_id, quantity))
 
-def get_connection():
-    return sqlite3.connect('burgers.db')
 
+@metrics.timed_query
+async def async_get_cart(user_id):
+    async with _current_pool().reader() as db:
+        return await db.execute_fetchall('''
+            SELECT b.id, b.name, b.description, b.price, c.quantity, c.updated_at
+            FROM cart c
+            JOIN burgers b ON c.burger_id = b.id
+            WHERE c.user_id = ?
+        ''', (user_id,))
 
-async def async_get_connection():
-    return await aiosqlite.connect('burgers.db')
 
+@metrics.timed_query
+async def async_remove_from_cart(user_id, burger_id, quantity):
+    async with _current_pool().writer() as db:
+        await db.execute(CART_DECREMENT, (quantity, user_id, burger_id))
+        await db.execute(CART_DELETE_EMPTY, (user_id, burger_id))
 
-def init_db():
-    with get_connection() as conn:
-        cursor = conn.cursor()
-
-        # Таблица бургеров
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS burgers (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                name TEXT NOT NULL,
-                description TEXT NOT NULL,
-                price INTEGER NOT NULL DEFAULT 1
-            )
-        ''')
-
-        # Таблица корзины
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS cart (
-                user_id INTEGER NOT NULL,
-                burger_id INTEGER NOT NULL,
-                quantity INTEGER NOT NULL DEFAULT 1,
-                FOREIGN KEY (burger_id) REFERENCES burgers (id)
-            )
-        ''')
-
-        # Таблица платежей
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS payments (
-                user_id INTEGER,
-                payment_id TEXT,
-                amount INTEGER,
-                currency TEXT,
-                timestamp DATETIME DEFAULT CURRENT_TIMESTAMP,
-                PRIMARY KEY (user_id, payment_id)
-            )
-        ''')
 
-        # Таблица состояний пользователя
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS user_states (
-                user_id INTEGER PRIMARY KEY,
-                state TEXT NOT NULL
-            )
-        ''')
+@metrics.timed_query
+async def async_save_user_state(user_id, state):
+    async with _current_pool().writer() as db:
+        await db.execute(f'''
+            INSERT OR REPLACE INTO user_states (user_id, state, updated_at)
+            VALUES (?, ?, {NOW})
+        ''', (user_id, state))
+        await db.execute(USER_UPSERT, (user_id,))
 
-        conn.commit()
 
+@metrics.timed_query
+async def async_save_user_states(states):
+    async with _current_pool().writer() as db:
+        await db.executemany(f'''
+            INSERT OR REPLACE INTO user_states (user_id, state, updated_at)
+            VALUES (?, ?, {NOW})
+        ''', states)
+        await db.executemany(USER_UPSERT, [(user_id,) for user_id, _ in states])
 
-def get_burgers():
-    with get_connection() as conn:
-        cursor = conn.cursor()
-        cursor.execute('SELECT * FROM burgers')
-        return cursor.fetchall()
 
+@metrics.timed_query
+async def async_get_user_state(user_id):
+    async with _current_pool().reader() as db:
+        async with db.execute('SELECT state FROM user_states WHERE user_id = ?', (user_id,)) as cursor:
+            result = await cursor.fetchone()
+            return result[0] if result else None
 
-def remove_burger(burger_id):
-    with get_connection() as conn:
-        cursor = conn.cursor()
-        cursor.execute('DELETE FROM burgers WHERE id = ?', (burger_id,))
-        conn.commit()
 
+@metrics.timed_query
+async def async_clear_cart(user_id):
+    async with _current_pool().writer() as db:
+        await db.execute('DELETE FROM cart WHERE user_id = ?', (user_id,))
 
-def add_to_cart(user_id, burger_id, quantity):
-    with get_connection() as conn:
-        cursor = conn.cursor()
-        cursor.execute('''
-            INSERT INTO cart (user_id, burger_id, quantity)
-            VALUES (?, ?, ?)
-        ''', (user_id, burger_id, quantity))
-        conn.commit()
+
+@metrics.timed_query
+async def async_save_invoice(payload, user_id, cart_hash, total, items, expires_at):
+    async with _current_pool().writer() as db:
+        await db.execute('''
+            INSERT INTO invoices (payload, user_id, cart_hash, total, items, expires_at)
+            VALUES (?, ?, ?, ?, ?, ?)
+        ''', (payload, user_id, cart_hash, total, items, expires_at))
 
 
-def get_cart(user_id):
-    with get_connection() as conn:
-        cursor = conn.cursor()
-        cursor.execute('''
-            SELECT b.id, b.name, b.description, b.price, c.quantity
+@metrics.timed_query
+async def async_get_invoice(payload):
+    async with _current_pool().reader() as db:
+        async with db.execute('''
+            SELECT user_id, cart_hash, total, items, expires_at
+            FROM invoices WHERE payload = ?
+        ''', (payload,)) as cursor:
+            return await cursor.fetchone()
+
+
+@metrics.timed_query
+async def async_delete_expired_invoices(now):
+    async with _current_pool().writer() as db:
+        cursor = await db.execute('DELETE FROM invoices WHERE expires_at <= ?', (now,))
+        return cursor.rowcount
+
+
+async def _record_order(db, user_id, charge_id, provider_charge_id, amount, currency, payload):
+    cursor = await db.execute('''
+        INSERT INTO orders (user_id, charge_id, provider_charge_id, amount, currency)
+        VALUES (?, ?, ?, ?, ?)
+        ON CONFLICT (charge_id) DO NOTHING
+    ''', (user_id, charge_id, provider_charge_id, amount, currency))
+    # Повторное уведомление о том же платеже: заказ уже оформлен
+    if cursor.rowcount == 0:
+        return None
+    order_id = cursor.lastrowid
+
+    await db.execute('''
+        INSERT INTO payments (user_id, payment_id, amount, currency)
+        VALUES (?, ?, ?, ?)
+    ''', (user_id, charge_id, amount, currency))
+
+    # Состав заказа берём из снимка счёта, а если его нет - из текущей корзины
+    async with db.execute('SELECT items FROM invoices WHERE payload = ?', (payload,)) as cursor:
+        invoice = await cursor.fetchone()
+    if invoice:
+        await db.executemany('''
+            INSERT INTO order_items (order_id, burger_id, name, price, quantity)
+            VALUES (?, ?, ?, ?, ?)
+        ''', [(order_id, *item) for item in json.loads(invoice[0])])
+        await db.execute('DELETE FROM invoices WHERE payload = ?', (payload,))
+    else:
+        await db.execute('''
+            INSERT INTO order_items (order_id, burger_id, name, price, quantity)
+            SELECT ?, b.id, b.name, b.price, c.quantity
             FROM cart c
             JOIN burgers b ON c.burger_id = b.id
             WHERE c.user_id = ?
-        ''', (user_id,))
-        return cursor.fetchall()
-
-
-def remove_from_cart(user_id, burger_id, quantity):
-    with get_connection() as conn:
-        cursor = conn.cursor()
-        cursor.execute('SELECT quantity FROM cart WHERE user_id = ? AND burger_id = ?', (user_id, burger_id))
-        result = cursor.fetchone()
-
-        if result:
-            current_quantity = result[0]
-            new_quantity = max(current_quantity - quantity, 0)
-
-            if new_quantity == 0:
-                cursor.execute('DELETE FROM cart WHERE user_id = ? AND burger_id = ?', (user_id, burger_id))
+        ''', (order_id, user_id))
+    await db.execute('DELETE FROM cart WHERE user_id = ?', (user_id,))
+
+    # Сводки для отчётов пополняются в той же транзакции - отчёты не сканируют заказы
+    await db.execute(f'''
+        INSERT INTO sales_hourly (hour, currency, orders, revenue)
+        VALUES ({HOUR}, ?, 1, ?)
+        ON CONFLICT (hour, currency) DO UPDATE SET
+            orders = orders + 1,
+            revenue = revenue + excluded.revenue
+    ''', (currency, amount))
+    await db.execute(f'''
+        INSERT INTO burger_sales_hourly (hour, burger_id, name, quantity, revenue)
+        SELECT {HOUR}, burger_id, name, quantity, price * quantity
+        FROM order_items
+        WHERE order_id = ?
+        ON CONFLICT (hour, burger_id) DO UPDATE SET
+            name = excluded.name,
+            quantity = quantity + excluded.quantity,
+            revenue = revenue + excluded.revenue
+    ''', (order_id,))
+    return order_id
+
+
+@metrics.timed_query
+async def async_record_orders(payments):
+    # Все платежи пачки пишутся одной транзакцией, каждый - в своей точке сохранения,
+    # чтобы ошибка в одном не откатывала остальные
+    results = []
+    async with _current_pool().writer() as db:
+        for payment in payments:
+            await db.execute('SAVEPOINT payment')
+            try:
+                order_id = await _record_order(db, *payment)
+            except sqlite3.Error as e:
+                await db.execute('ROLLBACK TO payment')
+                results.append(e)
             else:
-                cursor.execute('''
-                    UPDATE cart SET quantity = ?
-                    WHERE user_id = ? AND burger_id = ?
-                ''', (new_quantity, user_id, burger_id))
-
-            conn.commit()
-
+                results.append(order_id)
+            await db.execute('RELEASE payment')
+    return results
+
+
+@metrics.timed_query
+async def async_sales_report(since, until, bucket):
+    async with _current_pool().reader() as db:
+        return await db.execute_fetchall('''
+            SELECT hour / ? * ? AS period, currency, SUM(orders), SUM(revenue)
+            FROM sales_hourly
+            WHERE hour >= ? AND hour < ?
+            GROUP BY period, currency
+            ORDER BY period, currency
+        ''', (bucket, bucket, since, until))
+
+
+@metrics.timed_query
+async def async_top_burgers(since, until, limit):
+    async with _current_pool().reader() as db:
+        return await db.execute_fetchall('''
+            SELECT burger_id, MAX(name), SUM(quantity), SUM(revenue)
+            FROM burger_sales_hourly
+            WHERE hour >= ? AND hour < ?
+            GROUP BY burger_id
+            ORDER BY SUM(revenue) DESC, SUM(quantity) DESC
+            LIMIT ?
+        ''', (since, until, limit))
+
+
+@metrics.timed_query
+async def async_create_broadcast(text):
+    async with _current_pool().writer() as db:
+        cursor = await db.execute(f'INSERT INTO broadcasts (text, created_at) VALUES (?, {NOW})', (text,))
+        return cursor.lastrowid
+
+
+BROADCAST_COLUMNS = 'id, text, status, last_user_id, sent, failed, blocked, created_at, finished_at'
+
+
+@metrics.timed_query
+async def async_get_broadcast(broadcast_id):
+    async with _current_pool().reader() as db:
+        async with db.execute(f'SELECT {BROADCAST_COLUMNS} FROM broadcasts WHERE id = ?', (broadcast_id,)) as cursor:
+            return await cursor.fetchone()
+
+
+@metrics.timed_query
+async def async_get_broadcasts(status=None, limit=1):
+    async with _current_pool().reader() as db:
+        return await db.execute_fetchall(f'''
+            SELECT {BROADCAST_COLUMNS}
+            FROM broadcasts
+            WHERE ? IS NULL OR status = ?
+            ORDER BY id DESC
+            LIMIT ?
+        ''', (status, status, limit))
+
+
+@metrics.timed_query
+async def async_broadcast_recipients(after, limit):
+    # Постранично по первичному ключу: каждая пачка - короткое чтение без OFFSET
+    async with _current_pool().reader() as db:
+        rows = await db.execute_fetchall('''
+            SELECT user_id FROM users WHERE user_id > ? AND blocked_at IS NULL ORDER BY user_id LIMIT ?
+        ''', (after, limit))
+        return [row[0] for row in rows]
+
+
+@metrics.timed_query
+async def async_save_broadcast_progress(broadcast_id, last_user_id, sent, failed, blocked_ids):
+    # Прогресс и пометка заблокировавших бот (с удалением их состояний) - одной транзакцией.
+    # Корзины не трогаем: при нескольких воркерах их кэш у другого процесса, а брошенную корзину
+    # удалит обслуживание по CART_RETENTION_DAYS
+    async with _current_pool().writer() as db:
+        await db.execute('''
+            UPDATE broadcasts
+            SET last_user_id = ?, sent = sent + ?, failed = failed + ?, blocked = blocked + ?
+            WHERE id = ?
+        ''', (last_user_id, sent, failed, len(blocked_ids), broadcast_id))
+        if blocked_ids:
+            params = [(user_id,) for user_id in blocked_ids]
+            await db.executemany(f'UPDATE users SET blocked_at = {NOW} WHERE user_id = ?', params)
+            await db.executemany('DELETE FROM user_states WHERE user_id = ?', params)
+
+
+@metrics.timed_query
+async def async_finish_broadcast(broadcast_id, status):
+    async with _current_pool().writer() as db:
+        cursor = await db.execute(f'''
+            UPDATE broadcasts SET status = ?, finished_at = {NOW} WHERE id = ? AND status = 'running'
+        ''', (status, broadcast_id))
+        return cursor.rowcount
+
+
+# Обслуживание: каждая функция обрабатывает одну небольшую пачку в отдельной короткой транзакции
+
+@metrics.timed_query
+async def async_prune_user_states(before, limit):
+    async with _current_pool().writer() as db:
+        cursor = await db.execute('''
+            DELETE FROM user_states WHERE user_id IN (
+                SELECT user_id FROM user_states WHERE updated_at < ? LIMIT ?
+            )
+        ''', (before, limit))
+        return cursor.rowcount
+
+
+@metrics.timed_query
+async def async_prune_carts(before, limit):
+    # Корзина удаляется целиком, только если в ней давно ничего не менялось: у активной корзины
+    # старые позиции не теряются. Возвращает user_id, чтобы сбросить закэшированные корзины
+    async with _current_pool().writer() as db:
+        rows = await db.execute_fetchall('''
+            DELETE FROM cart WHERE user_id IN (
+                SELECT user_id FROM cart
+                WHERE user_id IN (SELECT user_id FROM cart WHERE updated_at < ?)
+                GROUP BY user_id
+                HAVING MAX(updated_at) < ?
+                LIMIT ?
+            )
+            RETURNING user_id
+        ''', (before, before, limit))
+        return list(dict.fromkeys(row[0] for row in rows))
+
+
+@metrics.timed_query
+async def async_archive_payments(before, limit, write):
+    # Архив пишется вне транзакции, чтобы сжатие и fsync не держали блокировку писателя.
+    # Удаление по ключам можно повторять: если процесс упадёт между записью и удалением,
+    # пачка попадёт в архив повторно, и при чтении архива её отсекают по (user_id, payment_id)
+    async with _current_pool().reader() as db:
+        rows = await db.execute_fetchall('''
+            SELECT user_id, payment_id, amount, currency, timestamp
+            FROM payments
+            WHERE timestamp < ?
+            ORDER BY timestamp
+            LIMIT ?
+        ''', (before, limit))
+    if not rows:
+        return 0
+
+    await write(rows)
+    async with _current_pool().writer() as db:
+        await db.executemany(
+            'DELETE FROM payments WHERE user_id = ? AND payment_id = ?',
+            [(row[0], row[1]) for row in rows]
+        )
+    return len(rows)
+
+
+@metrics.timed_query
+async def async_archive_orders(before, limit, write):
+    # Заказы уходят в архив вместе с составом, по той же схеме, что и платежи. Сводки продаж
+    # уже учли их, а повторное уведомление об оплате через год после неё не приходит
+    async with _current_pool().reader() as db:
+        orders = await db.execute_fetchall('''
+            SELECT id, user_id, charge_id, provider_charge_id, amount, currency, created_at
+            FROM orders
+            WHERE created_at < ?
+            ORDER BY created_at
+            LIMIT ?
+        ''', (before, limit))
+        if not orders:
+            return 0
+        items = await db.execute_fetchall(f'''
+            SELECT order_id, burger_id, name, price, quantity
+            FROM order_items
+            WHERE order_id IN ({','.join('?' * len(orders))})
+        ''', [row[0] for row in orders])
+
+    await write(orders, items)
+    params = [(row[0],) for row in orders]
+    async with _current_pool().writer() as db:
+        await db.executemany('DELETE FROM order_items WHERE order_id = ?', params)
+        await db.executemany('DELETE FROM orders WHERE id = ?', params)
+    return len(orders)
+
+
+@metrics.timed_query
+async def async_incremental_vacuum(pages):
+    # Через execute прагма делает один шаг и освобождает одну страницу; executescript доводит её до конца,
+    # но фиксирует открытую транзакцию, поэтому нужен писатель без транзакции
+    async with _current_pool().autocommit() as db:
+        await db.executescript(f'PRAGMA incremental_vacuum({int(pages)})')
+        return (await db.execute_fetchall('PRAGMA freelist_count'))[0][0]
+
+
+@metrics.timed_query
+async def async_analyze(limit):
+    async with _current_pool().writer() as db:
+        # analysis_limit ограничивает число строк, просматриваемых в каждом индексе
+        await db.execute_fetchall(f'PRAGMA analysis_limit = {int(limit)}')
+        await db.execute('ANALYZE')
+
+
+# Синхронные обёртки для скриптов и консоли. Из кода бота (внутри цикла событий) вызывать нельзя:
+# они блокируют поток до завершения запроса
+
+def _run_sync(function, *args):
+    try:
+        asyncio.get_running_loop()
+    except RuntimeError:
+        pass
+    else:
+        raise RuntimeError(f'{function.__name__} блокирует цикл событий, используйте async-версию')
+
+    async def call():
+        private = pool.clone(readers=1)
+        token = _active_pool.set(private)
+        try:
+            return await function(*args)
+        finally:
+            _active_pool.reset(token)
+            await private.close()
+
+    return asyncio.run(call())
 
-def save_user_state(user_id, state):
-    with get_connection() as conn:
-        cursor = conn.cursor()
-        cursor.execute('''
-            INSERT OR REPLACE INTO user_states (user_id, state)
-            VALUES (?, ?)
-        ''', (user_id, state))
-        conn.commit()
 
+def init_db():
+    _run_sync(async_init_db)
 
-def get_user_state(user_id):
-    with get_connection() as conn:
-        cursor = conn.cursor()
-        cursor.execute('SELECT state FROM user_states WHERE user_id = ?', (user_id,))
-        result = cursor.fetchone()
-        return result[0] if result else None
 
+def get_burgers():
+    return _run_sync(async_get_burgers)
 
-# Асинхронные версии функций
 
-async def async_get_burgers():
-    async with aiosqlite.connect('burgers.db') as db:
-        async with db.execute('SELECT * FROM burgers') as cursor:
-            return await cursor.fetchall()
+def remove_burger(burger_id):
+    return _run_sync(async_remove_burger, burger_id)
 
 
-async def async_add_to_cart(user_id, burger_id, quantity):
-    async with aiosqlite.connect('burgers.db') as db:
-        await db.execute('''
-            INSERT INTO cart (user_id, burger_id, quantity)
-            VALUES (?, ?, ?)
-        ''', (user_id, burger_id, quantity))
-        await db.commit()
+def import_burgers(rows):
+    return _run_sync(async_import_burgers, rows)
 
 
-async def async_get_cart(user_id):
-    async with aiosqlite.connect('burgers.db') as db:
-        async with db.execute('''
-            SELECT b.id, b.name, b.description, b.price, c.quantity
-            FROM cart c
-            JOIN burgers b ON c.burger_id = b.id
-            WHERE c.user_id = ?
-        ''', (user_id,)) as cursor:
-            return await cursor.fetchall()
-
-
-async def async_remove_from_cart(user_id, burger_id, quantity):
-    async with aiosqlite.connect('burgers.db') as db:
-        async with db.execute('SELECT quantity FROM cart WHERE user_id = ? AND burger_id = ?',
-                              (user_id, burger_id)) as cursor:
-            result = await cursor.fetchone()
-
-            if result:
-                current_quantity = result[0]
-                new_quantity = max(current_quantity - quantity, 0)
+def add_to_cart(user_id, burger_id, quantity):
+    _run_sync(async_add_to_cart, user_id, burger_id, quantity)
 
-                if new_quantity == 0:
-                    await db.execute('DELETE FROM cart WHERE user_id = ? AND burger_id = ?', (user_id, burger_id))
-                else:
-                    await db.execute('''
-                        UPDATE cart SET quantity = ?
-                        WHERE user_id = ? AND burger_id = ?
-                    ''', (new_quantity, user_id, burger_id))
 
-                await db.commit()
+def get_cart(user_id):
+    return _run_sync(async_get_cart, user_id)
 
 
-async def async_save_user_state(user_id, state):
-    async with aiosqlite.connect('burgers.db') as db:
-        await db.execute('''
-            INSERT OR REPLACE INTO user_states (user_id, state)
-            VALUES (?, ?)
-        ''', (user_id, state))
-        await db.commit()
+def remove_from_cart(user_id, burger_id, quantity):
+    _run_sync(async_remove_from_cart, user_id, burger_id, quantity)
 
 
-async def async_get_user_state(user_id):
-    async with aiosqlite.connect('burgers.db') as db:
-        async with db.execute('SELECT state FROM user_states WHERE user_id = ?', (user_id,)) as cursor:
-            result = await cursor.fetchone()
-            return result[0] if result else None
+def save_user_state(user_id, state):
+    _run_sync(async_save_user_state, user_id, state)
 
 
-async def async_clear_cart(user_id):
-    async with aiosqlite.connect('burgers.db') as db:
-        await db.execute('DELETE FROM cart WHERE user_id = ?', (user_id,))
-        await db.commit()
+def get_user_state(user_id):
+    return _run_sync(async_get_user_state, user_id)
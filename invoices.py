@@ -0,0 +1,119 @@
+import asyncio
+import hashlib
+import json
+import logging
+import secrets
+import time
+
+import config
+import database
+
+logger = logging.getLogger(__name__)
+
+
+def cart_total(cart_items):
+    return sum(item[3] * item[4] for item in cart_items)
+
+
+def cart_hash(cart_items):
+    lines = sorted((item[0], item[3], item[4]) for item in cart_items)
+    return hashlib.sha256(json.dumps(lines).encode()).hexdigest()
+
+
+class Snapshot:
+    __slots__ = ('payload', 'user_id', 'cart_hash', 'total', 'items', 'expires_at')
+
+    def __init__(self, payload, user_id, cart_hash, total, items, expires_at):
+        self.payload = payload
+        self.user_id = user_id
+        self.cart_hash = cart_hash
+        self.total = total
+        self.items = items
+        self.expires_at = expires_at
+
+    @property
+    def expired(self):
+        return self.expires_at <= time.time()
+
+
+class InvoiceStore:
+    def __init__(self, ttl=config.INVOICE_TTL, cleanup_interval=config.INVOICE_CLEANUP_INTERVAL):
+        self.ttl = ttl
+        self.cleanup_interval = cleanup_interval
+        self._snapshots = {}
+        self._task = None
+
+    async def create(self, user_id, cart_items):
+        items = [[item[0], item[1], item[3], item[4]] for item in cart_items]
+        snapshot = Snapshot(
+            payload=secrets.token_urlsafe(16),
+            user_id=user_id,
+            cart_hash=cart_hash(cart_items),
+            total=cart_total(cart_items),
+            items=items,
+            expires_at=int(time.time() + self.ttl)
+        )
+        await database.async_save_invoice(snapshot.payload, user_id, snapshot.cart_hash,
+                                          snapshot.total, json.dumps(items, ensure_ascii=False),
+                                          snapshot.expires_at)
+        self._snapshots[snapshot.payload] = snapshot
+        return snapshot
+
+    async def get(self, payload):
+        snapshot = self._snapshots.get(payload)
+        if snapshot is None:
+            # Инвойс мог быть выставлен другим процессом или до перезапуска
+            row = await database.async_get_invoice(payload)
+            if row is None:
+                return None
+            snapshot = Snapshot(payload, row[0], row[1], row[2], json.loads(row[3]), row[4])
+            self._snapshots[payload] = snapshot
+        return snapshot
+
+    async def validate(self, user_id, payload, amount, currency):
+        snapshot = await self.get(payload)
+        if snapshot is None or snapshot.user_id != user_id:
+            return 'Счёт не найден. Оформите заказ заново.'
+        if snapshot.expired:
+            return 'Срок действия счёта истёк. Оформите заказ заново.'
+        if currency != 'XTR' or amount != snapshot.total:
+            return 'Сумма счёта не совпадает с заказом.'
+        if cart_hash(await database.async_get_cart(user_id)) != snapshot.cart_hash:
+            return 'Корзина изменилась после выставления счёта. Оформите заказ заново.'
+        return None
+
+    def forget(self, payload):
+        self._snapshots.pop(payload, None)
+
+    async def cleanup(self):
+        now = time.time()
+        for payload in [payload for payload, snapshot in self._snapshots.items() if snapshot.expires_at <= now]:
+            del self._snapshots[payload]
+        return await database.async_delete_expired_invoices(int(now))
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.cleanup_interval)
+            try:
+                removed = await self.cleanup()
+            except Exception:
+                logger.exception('Не удалось удалить просроченные счета')
+            else:
+                if removed:
+                    logger.info('Удалено просроченных счетов: %d', removed)
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+
+store = InvoiceStore()
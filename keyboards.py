@@ -0,0 +1,106 @@
+from collections import OrderedDict
+
+from aiogram.types import InlineKeyboardButton, InlineKeyboardMarkup
+
+import callbacks
+import catalog
+import config
+
+
+def build_menu_page(burgers, has_prev, has_next):
+    if not burgers:
+        return None
+    rows = [
+        [InlineKeyboardButton(text=burger[1], callback_data=f'burger_{burger[0]}')]
+        for burger in burgers
+    ]
+    navigation = []
+    if has_prev:
+        cursor = callbacks.MenuPage(direction='prev', cursor=burgers[0][0]).pack()
+        navigation.append(InlineKeyboardButton(text='« Назад', callback_data=cursor))
+    if has_next:
+        cursor = callbacks.MenuPage(direction='next', cursor=burgers[-1][0]).pack()
+        navigation.append(InlineKeyboardButton(text='Далее »', callback_data=cursor))
+    if navigation:
+        rows.append(navigation)
+    return InlineKeyboardMarkup(inline_keyboard=rows)
+
+
+def build_details(burger_id):
+    return InlineKeyboardMarkup(inline_keyboard=[
+        [InlineKeyboardButton(text='Выбрать количество', callback_data=f'burger_{burger_id}')]
+    ])
+
+
+def build_quantity(burger_id, quantity):
+    def step(action):
+        return callbacks.QuantityCallback.signed(action, burger_id, quantity).pack()
+
+    return InlineKeyboardMarkup(inline_keyboard=[
+        [
+            InlineKeyboardButton(text='-', callback_data=step('decrease')),
+            InlineKeyboardButton(text=str(quantity), callback_data=f'quantity_{burger_id}_{quantity}'),
+            InlineKeyboardButton(text='+', callback_data=step('increase'))
+        ],
+        [InlineKeyboardButton(text='Добавить в корзину', callback_data=step('add'))]
+    ])
+
+
+class KeyboardCache:
+    # Разметки общие для всех ответов: их нельзя изменять после выдачи, только заменять целиком
+    def __init__(self, menu=catalog.menu, size=config.KEYBOARD_CACHE_SIZE):
+        self.menu = menu
+        self.size = size
+        self.version = None
+        self._markups = OrderedDict()
+        self._payment = InlineKeyboardMarkup(inline_keyboard=[
+            [InlineKeyboardButton(text='Оплатить Stars', pay=True)]
+        ])
+        self._cart = InlineKeyboardMarkup(inline_keyboard=[[
+            InlineKeyboardButton(text='Оплатить Stars', callback_data='buy'),
+            InlineKeyboardButton(text='Удалить позиции', callback_data='clear_cart')
+        ]])
+
+    def _sync(self):
+        # Каталог изменился - выбрасываем всё, что было построено для прошлой версии
+        if self.menu.version != self.version:
+            self.version = self.menu.version
+            self._markups.clear()
+
+    def _remember(self, key, build, *args):
+        if key in self._markups:
+            self._markups.move_to_end(key)
+            return self._markups[key]
+
+        markup = self._markups[key] = build(*args)
+        if len(self._markups) > self.size:
+            self._markups.popitem(last=False)
+        return markup
+
+    async def menu_page(self, cursor=0, forward=True):
+        page = await self.menu.get_page(cursor, forward)
+        self._sync()
+        return self._remember(('page', cursor, forward), build_menu_page, *page)
+
+    async def warm(self):
+        # Первая страница меню и стартовые клавиатуры количества - самые частые ответы
+        await self.menu_page()
+        for burger in self.menu.burgers[:self.size // 2]:
+            self.quantity(burger[0], 1)
+
+    def quantity(self, burger_id, quantity):
+        self._sync()
+        return self._remember(('quantity', burger_id, quantity), build_quantity, burger_id, quantity)
+
+    def details(self, burger_id):
+        self._sync()
+        return self._remember(('details', burger_id), build_details, burger_id)
+
+    def payment(self):
+        return self._payment
+
+    def cart(self):
+        return self._cart
+
+
+cache = KeyboardCache()
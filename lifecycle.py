@@ -0,0 +1,74 @@
+import asyncio
+import logging
+import os
+import socket
+import time
+
+from aiogram import BaseMiddleware
+
+import metrics
+
+logger = logging.getLogger(__name__)
+
+
+def notify_systemd(state):
+    # Протокол sd_notify: сообщаем systemd о готовности и об остановке, если запущены под ним
+    address = os.environ.get('NOTIFY_SOCKET')
+    if not address:
+        return
+    if address.startswith('@'):
+        address = '\0' + address[1:]
+    try:
+        with socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM) as sock:
+            sock.sendto(state.encode(), address)
+    except OSError as e:
+        logger.warning('Не удалось уведомить systemd: %s', e)
+
+
+def set_ready(ready, systemd=True):
+    metrics.ready.set(int(ready))
+    # Воркеры шардированного режима systemd не уведомляют: за весь сервис отвечает фронт-процесс
+    if systemd:
+        notify_systemd('READY=1' if ready else 'STOPPING=1')
+    logger.info('Бот готов принимать обновления' if ready else 'Бот останавливается')
+
+
+class InflightTracker(BaseMiddleware):
+    # Считает обновления в обработке, чтобы при остановке дождаться их завершения
+    def __init__(self):
+        self._count = 0
+        self._idle = asyncio.Event()
+        self._idle.set()
+
+    async def __call__(self, handler, event, data):
+        self._count += 1
+        self._idle.clear()
+        try:
+            return await handler(event, data)
+        finally:
+            self._count -= 1
+            if not self._count:
+                self._idle.set()
+
+    async def drain(self, timeout):
+        # Задачи, созданные поллингом перед остановкой, могли ещё не дойти до middleware
+        await asyncio.sleep(0)
+        if self._idle.is_set():
+            return
+        logger.info('Ожидание завершения %d обработчиков', self._count)
+        try:
+            await asyncio.wait_for(self._idle.wait(), timeout=timeout)
+        except asyncio.TimeoutError:
+            logger.warning('Не дождались %d обработчиков за %s с', self._count, timeout)
+
+
+class Deadline:
+    def __init__(self, timeout):
+        self.expires = time.monotonic() + timeout
+
+    @property
+    def remaining(self):
+        return max(self.expires - time.monotonic(), 0)
+
+
+inflight = InflightTracker()
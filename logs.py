@@ -0,0 +1,73 @@
+import json
+import logging
+import random
+import time
+
+import config
+
+# Стандартные атрибуты LogRecord; всё остальное пришло через extra= и попадает в JSON как поля
+_RESERVED = frozenset(logging.makeLogRecord({}).__dict__) | {'message', 'asctime'}
+
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record):
+        entry = {
+            'time': self.formatTime(record),
+            'level': record.levelname,
+            'logger': record.name,
+            'message': record.getMessage()
+        }
+        for key, value in record.__dict__.items():
+            if key not in _RESERVED and not key.startswith('_'):
+                entry[key] = value
+        if record.exc_info:
+            entry['exception'] = self.formatException(record.exc_info)
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+
+class TextFormatter(logging.Formatter):
+    def format(self, record):
+        line = super().format(record)
+        suppressed = getattr(record, 'suppressed', 0)
+        return f'{line} (ещё {suppressed} таких же подавлено)' if suppressed else line
+
+
+class SamplingFilter(logging.Filter):
+    def __init__(self, sample_rate=config.LOG_SAMPLE_RATE, repeat_limit=config.LOG_REPEAT_LIMIT,
+                 repeat_interval=config.LOG_REPEAT_INTERVAL):
+        super().__init__()
+        self.sample_rate = sample_rate
+        self.repeat_limit = repeat_limit
+        self.repeat_interval = repeat_interval
+        self._windows = {}
+
+    def filter(self, record):
+        if record.levelno >= logging.ERROR:
+            return True
+        if record.levelno < logging.WARNING:
+            return self.sample_rate >= 1 or random.random() < self.sample_rate
+
+        # Одинаковые предупреждения (например, flood control) пропускаем не чаще repeat_limit за интервал
+        key = (record.name, record.msg)
+        now = time.monotonic()
+        window = self._windows.get(key)
+        if window is None or now - window[0] >= self.repeat_interval:
+            if window is not None and window[2]:
+                record.suppressed = window[2]
+            self._windows[key] = [now, 1, 0]
+            return True
+        if window[1] < self.repeat_limit:
+            window[1] += 1
+            return True
+        window[2] += 1
+        return False
+
+
+def setup():
+    handler = logging.StreamHandler()
+    if config.LOG_FORMAT == 'json':
+        handler.setFormatter(JsonFormatter())
+    else:
+        handler.setFormatter(TextFormatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s'))
+    handler.addFilter(SamplingFilter())
+    logging.basicConfig(level=config.LOG_LEVEL, handlers=[handler])
@@ -0,0 +1,118 @@
+import asyncio
+import gzip
+import json
+import logging
+import os
+import time
+
+import carts
+import config
+import database
+import sharding
+
+logger = logging.getLogger(__name__)
+
+DAY = 24 * 60 * 60
+
+
+PAYMENT_FIELDS = ('user_id', 'payment_id', 'amount', 'currency', 'timestamp')
+ORDER_FIELDS = ('id', 'user_id', 'charge_id', 'provider_charge_id', 'amount', 'currency', 'created_at')
+ORDER_ITEM_FIELDS = ('burger_id', 'name', 'price', 'quantity')
+
+
+def write_archive(directory, kind, records):
+    os.makedirs(directory, exist_ok=True)
+    path = os.path.join(directory, time.strftime(f'{kind}-%Y-%m.jsonl.gz', time.gmtime()))
+    lines = ''.join(json.dumps(record, ensure_ascii=False) + '\n' for record in records)
+    # Каждая пачка - отдельный gzip-член: файл остаётся читаемым, даже если запись оборвётся
+    with open(path, 'ab') as file:
+        file.write(gzip.compress(lines.encode()))
+        file.flush()
+        os.fsync(file.fileno())
+
+
+class Maintenance:
+    def __init__(self, interval=config.MAINTENANCE_INTERVAL, batch_size=config.MAINTENANCE_BATCH,
+                 pause=config.MAINTENANCE_BATCH_PAUSE, budget=config.MAINTENANCE_TIME_BUDGET):
+        self.interval = interval
+        self.batch_size = batch_size
+        self.pause = pause
+        self.budget = budget
+        self._task = None
+
+    async def _batches(self, job, *args):
+        # Пачки с паузами между ними, пока есть работа и не исчерпан бюджет времени;
+        # остаток доделается в следующий запуск
+        total = 0
+        deadline = time.monotonic() + self.budget
+        while time.monotonic() < deadline:
+            count = await job(*args, self.batch_size)
+            total += count
+            if count < self.batch_size:
+                break
+            await asyncio.sleep(self.pause)
+        return total
+
+    async def _archive_payments(self, rows):
+        records = [dict(zip(PAYMENT_FIELDS, row)) for row in rows]
+        await asyncio.to_thread(write_archive, config.PAYMENTS_ARCHIVE_DIR, 'payments', records)
+
+    async def _archive_orders(self, orders, items):
+        records = {row[0]: dict(zip(ORDER_FIELDS, row), items=[]) for row in orders}
+        for item in items:
+            records[item[0]]['items'].append(dict(zip(ORDER_ITEM_FIELDS, item[1:])))
+        await asyncio.to_thread(write_archive, config.PAYMENTS_ARCHIVE_DIR, 'orders', list(records.values()))
+
+    async def _archive_payments_batch(self, before, limit):
+        return await database.async_archive_payments(before, limit, self._archive_payments)
+
+    async def _archive_orders_batch(self, before, limit):
+        return await database.async_archive_orders(before, limit, self._archive_orders)
+
+    async def _prune_carts_batch(self, before, limit):
+        user_ids = await database.async_prune_carts(before, limit)
+        carts.cache.forget(user_ids)
+        return len(user_ids)
+
+    async def run_once(self):
+        now = time.time()
+        states = await self._batches(database.async_prune_user_states,
+                                     int(now - config.STATE_RETENTION_DAYS * DAY))
+        cart_users = await self._batches(self._prune_carts_batch,
+                                         int(now - config.CART_RETENTION_DAYS * DAY))
+        payments = orders = 0
+        if config.PAYMENTS_RETENTION_DAYS:
+            before = time.strftime('%Y-%m-%d %H:%M:%S', time.gmtime(now - config.PAYMENTS_RETENTION_DAYS * DAY))
+            payments = await self._batches(self._archive_payments_batch, before)
+            orders = await self._batches(self._archive_orders_batch, before)
+        free_pages = await database.async_incremental_vacuum(config.MAINTENANCE_VACUUM_PAGES)
+        await database.async_analyze(config.MAINTENANCE_ANALYZE_LIMIT)
+        logger.info('Обслуживание базы: удалено состояний %d, брошенных корзин %d, в архив ушло платежей %d '
+                    'и заказов %d, свободных страниц осталось %d', states, cart_users, payments, orders, free_pages,
+                    extra={'pruned_states': states, 'pruned_carts': cart_users, 'archived_payments': payments,
+                           'archived_orders': orders, 'free_pages': free_pages})
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            try:
+                await self.run_once()
+            except Exception:
+                logger.exception('Не удалось выполнить обслуживание базы')
+
+    def start(self):
+        # При нескольких воркерах база общая: обслуживание ведёт только воркер с шардом 0
+        if self.interval and self._task is None and sharding.owns(0):
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+
+jobs = Maintenance()
@@ -0,0 +1,211 @@
+import bisect
+import contextvars
+import functools
+import logging
+import time
+
+from aiohttp import web
+from aiogram import BaseMiddleware
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware
+from aiogram.exceptions import TelegramAPIError, TelegramRetryAfter
+
+import config
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+_registry = []
+_runner = None
+_route = contextvars.ContextVar('metrics_route', default=None)
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _format_labels(names, values, extra=()):
+    pairs = [f'{name}="{_escape(value)}"' for name, value in (*zip(names, values), *extra)]
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+class Counter:
+    kind = 'counter'
+
+    def __init__(self, name, documentation, labels=()):
+        self.name = name
+        self.documentation = documentation
+        self.labels = labels
+        self._values = {}
+        _registry.append(self)
+
+    def inc(self, *labels, amount=1):
+        self._values[labels] = self._values.get(labels, 0) + amount
+
+    def samples(self):
+        for labels, value in self._values.items():
+            yield self.name + _format_labels(self.labels, labels), value
+
+
+class Gauge(Counter):
+    kind = 'gauge'
+
+    def dec(self, *labels, amount=1):
+        self.inc(*labels, amount=-amount)
+
+    def set(self, value, *labels):
+        self._values[labels] = value
+
+    def value(self, *labels):
+        return self._values.get(labels, 0)
+
+
+class Histogram:
+    kind = 'histogram'
+
+    def __init__(self, name, documentation, labels=(), buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labels = labels
+        self.buckets = buckets
+        self._values = {}
+        _registry.append(self)
+
+    def observe(self, value, *labels):
+        state = self._values.get(labels)
+        if state is None:
+            state = self._values[labels] = [[0] * (len(self.buckets) + 1), 0.0]
+        state[0][bisect.bisect_left(self.buckets, value)] += 1
+        state[1] += value
+
+    def samples(self):
+        for labels, (counts, total) in self._values.items():
+            cumulative = 0
+            for bound, count in zip((*self.buckets, '+Inf'), counts):
+                cumulative += count
+                yield self.name + '_bucket' + _format_labels(self.labels, labels, (('le', bound),)), cumulative
+            yield self.name + '_sum' + _format_labels(self.labels, labels), total
+            yield self.name + '_count' + _format_labels(self.labels, labels), cumulative
+
+
+def render():
+    lines = []
+    for metric in _registry:
+        lines.append(f'# HELP {metric.name} {metric.documentation}')
+        lines.append(f'# TYPE {metric.name} {metric.kind}')
+        lines.extend(f'{name} {value}' for name, value in metric.samples())
+    return '\n'.join(lines) + '\n'
+
+
+update_duration = Histogram('bot_update_duration_seconds', 'Время обработки обновления', ('route',))
+update_errors = Counter('bot_update_errors_total', 'Обновления, завершившиеся исключением', ('route',))
+updates_in_flight = Gauge('bot_updates_in_flight', 'Обновления в обработке')
+query_duration = Histogram('bot_db_query_duration_seconds', 'Время запросов к базе данных', ('query',))
+query_errors = Counter('bot_db_query_errors_total', 'Ошибки запросов к базе данных', ('query',))
+api_duration = Histogram('bot_api_request_duration_seconds', 'Время запросов к Bot API', ('method',))
+api_errors = Counter('bot_api_errors_total', 'Ошибки запросов к Bot API', ('method', 'error'))
+ready = Gauge('bot_ready', 'Бот прогрет и принимает обновления')
+
+
+def timed_query(function):
+    name = function.__name__
+
+    @functools.wraps(function)
+    async def wrapper(*args, **kwargs):
+        started = time.perf_counter()
+        try:
+            return await function(*args, **kwargs)
+        except Exception:
+            query_errors.inc(name)
+            raise
+        finally:
+            spent = time.perf_counter() - started
+            query_duration.observe(spent, name)
+            if spent * 1000 >= config.SLOW_QUERY_MS:
+                logger.warning('Медленный запрос к базе %s: %.1f мс', name, spent * 1000,
+                               extra={'query': name, 'duration_ms': round(spent * 1000, 2)})
+    return wrapper
+
+
+class UpdateMetricsMiddleware(BaseMiddleware):
+    # Внешний middleware: меряет обновление целиком, маршрут подставляет RouteMiddleware
+    async def __call__(self, handler, event, data):
+        route = [None]
+        token = _route.set(route)
+        updates_in_flight.inc()
+        started = time.perf_counter()
+        try:
+            return await handler(event, data)
+        except Exception:
+            update_errors.inc(route[0] or 'unhandled')
+            raise
+        finally:
+            updates_in_flight.dec()
+            update_duration.observe(time.perf_counter() - started, route[0] or 'unhandled')
+            _route.reset(token)
+
+
+class RouteMiddleware(BaseMiddleware):
+    async def __call__(self, handler, event, data):
+        route = _route.get()
+        if route is not None:
+            route[0] = data['handler'].callback.__name__
+        return await handler(event, data)
+
+
+class ApiMetricsMiddleware(BaseRequestMiddleware):
+    async def __call__(self, make_request, bot, method):
+        name = method.__api_method__
+        started = time.perf_counter()
+        try:
+            return await make_request(bot, method)
+        except TelegramRetryAfter:
+            api_errors.inc(name, 'retry_after')
+            raise
+        except TelegramAPIError as e:
+            api_errors.inc(name, type(e).__name__)
+            raise
+        finally:
+            api_duration.observe(time.perf_counter() - started, name)
+
+
+def setup(dp, bot):
+    dp.update.outer_middleware(UpdateMetricsMiddleware())
+    route_middleware = RouteMiddleware()
+    for name, observer in dp.observers.items():
+        if name not in ('update', 'error'):
+            observer.middleware(route_middleware)
+    bot.session.middleware(ApiMetricsMiddleware())
+
+
+async def handle_metrics(request):
+    return web.Response(text=render(), content_type='text/plain', charset='utf-8')
+
+
+async def handle_ready(request):
+    # Для балансировщика и оркестратора: 503 во время прогрева и остановки
+    if ready.value():
+        return web.Response(text='ok')
+    return web.Response(text='not ready', status=503)
+
+
+async def start_server(host=config.METRICS_HOST, port=None):
+    global _runner
+    port = config.METRICS_PORT if port is None else port
+    if not port or _runner is not None:
+        return
+    app = web.Application()
+    app.router.add_get('/metrics', handle_metrics)
+    app.router.add_get('/ready', handle_ready)
+    runner = web.AppRunner(app, handle_signals=False, access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, host, port).start()
+    _runner = runner
+    logger.info('Метрики доступны на %s:%s/metrics', host, port)
+
+
+async def stop_server():
+    global _runner
+    if _runner is not None:
+        await _runner.cleanup()
+        _runner = None
@@ -0,0 +1,26 @@
+import asyncio
+
+from aiogram import BaseMiddleware
+
+
+class UserOrderMiddleware(BaseMiddleware):
+    # Обновления одного пользователя обрабатываются строго по очереди, разных - параллельно
+    def __init__(self):
+        self._locks = {}
+
+    async def __call__(self, handler, event, data):
+        user = data.get('event_from_user')
+        if user is None:
+            return await handler(event, data)
+
+        entry = self._locks.get(user.id)
+        if entry is None:
+            entry = self._locks[user.id] = [asyncio.Lock(), 0]
+        entry[1] += 1
+        try:
+            async with entry[0]:
+                return await handler(event, data)
+        finally:
+            entry[1] -= 1
+            if not entry[1]:
+                del self._locks[user.id]
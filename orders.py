@@ -0,0 +1,65 @@
+import asyncio
+import logging
+
+import config
+import database
+
+logger = logging.getLogger(__name__)
+
+
+class OrderQueue:
+    def __init__(self, batch_size=config.ORDER_BATCH_SIZE):
+        self.batch_size = batch_size
+        self._queue = asyncio.Queue()
+        self._task = None
+
+    async def submit(self, user_id, charge_id, provider_charge_id, amount, currency, payload):
+        self.start()
+        future = asyncio.get_running_loop().create_future()
+        self._queue.put_nowait(((user_id, charge_id, provider_charge_id, amount, currency, payload), future))
+        return await future
+
+    async def _process(self, batch):
+        try:
+            results = await database.async_record_orders([payment for payment, _ in batch])
+        except Exception as e:
+            logger.exception('Не удалось записать %d платежей', len(batch))
+            results = [e] * len(batch)
+
+        for (_, future), result in zip(batch, results):
+            if future.done():
+                continue
+            if isinstance(result, Exception):
+                future.set_exception(result)
+            else:
+                future.set_result(result)
+
+    async def _run(self):
+        while True:
+            batch = [await self._queue.get()]
+            # Всплеск платежей записываем пачкой за одну транзакцию
+            while len(batch) < self.batch_size and not self._queue.empty():
+                batch.append(self._queue.get_nowait())
+            try:
+                await self._process(batch)
+            finally:
+                for _ in batch:
+                    self._queue.task_done()
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is None:
+            return
+        await self._queue.join()
+        self._task.cancel()
+        try:
+            await self._task
+        except asyncio.CancelledError:
+            pass
+        self._task = None
+
+
+queue = OrderQueue()
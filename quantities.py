@@ -0,0 +1,102 @@
+import asyncio
+import logging
+from collections import OrderedDict
+
+from aiogram.exceptions import TelegramBadRequest
+
+import config
+import keyboards
+import states
+
+logger = logging.getLogger(__name__)
+
+
+def is_not_modified(error):
+    return 'message is not modified' in str(error)
+
+
+class _Stepper:
+    __slots__ = ('user_id', 'burger_id', 'quantity', 'shown', 'task')
+
+    def __init__(self, user_id, burger_id, quantity):
+        self.user_id = user_id
+        self.burger_id = burger_id
+        self.quantity = quantity
+        self.shown = quantity
+        self.task = None
+
+
+class QuantityStepper:
+    def __init__(self, delay=config.STEPPER_DEBOUNCE, size=config.STEPPER_CACHE_SIZE):
+        self.delay = delay
+        self.size = size
+        self._messages = OrderedDict()
+        self._added = OrderedDict()
+
+    def _get(self, chat_id, message_id, user_id, burger_id, quantity):
+        key = (chat_id, message_id)
+        stepper = self._messages.get(key)
+        if stepper is None or stepper.burger_id != burger_id:
+            stepper = self._messages[key] = _Stepper(user_id, burger_id, quantity)
+            if len(self._messages) > self.size:
+                self._messages.popitem(last=False)
+        else:
+            self._messages.move_to_end(key)
+        return stepper
+
+    def claim(self, chat_id, message_id, burger_id, quantity):
+        # В корзину из одного сообщения добавляем один раз: повторное нажатие «Добавить» возвращает None.
+        # Кнопка в уже устаревшей клавиатуре несёт старое количество - верим последнему нажатию
+        key = (chat_id, message_id)
+        if key in self._added:
+            return None
+        self._added[key] = burger_id
+        if len(self._added) > self.size:
+            self._added.popitem(last=False)
+
+        stepper = self._messages.pop(key, None)
+        if stepper is None:
+            return quantity
+        # Отложенная правка больше не нужна: клавиатуру с сообщения уберёт обработчик
+        if stepper.task is not None:
+            stepper.task.cancel()
+        return stepper.quantity if stepper.burger_id == burger_id else quantity
+
+    def step(self, bot, chat_id, message_id, user_id, burger_id, quantity, delta):
+        if (chat_id, message_id) in self._added:
+            return
+        stepper = self._get(chat_id, message_id, user_id, burger_id, quantity)
+        stepper.quantity = max(stepper.quantity + delta, 1)
+        # Серия быстрых нажатий даёт одно изменение клавиатуры по окончании окна
+        if stepper.quantity != stepper.shown and stepper.task is None:
+            stepper.task = asyncio.create_task(self._flush(bot, chat_id, message_id, stepper))
+
+    async def _flush(self, bot, chat_id, message_id, stepper):
+        try:
+            while True:
+                await asyncio.sleep(self.delay)
+                quantity = stepper.quantity
+                if quantity == stepper.shown:
+                    return
+                try:
+                    await bot.edit_message_reply_markup(
+                        chat_id=chat_id,
+                        message_id=message_id,
+                        reply_markup=keyboards.cache.quantity(stepper.burger_id, quantity)
+                    )
+                except TelegramBadRequest as e:
+                    if not is_not_modified(e):
+                        logger.warning('Не удалось обновить количество: %s', e)
+                        return
+                stepper.shown = quantity
+                await states.store.set(stepper.user_id, f'awaiting_quantity_{stepper.burger_id}_{quantity}')
+        finally:
+            stepper.task = None
+
+    async def stop(self):
+        tasks = [stepper.task for stepper in self._messages.values() if stepper.task is not None]
+        if tasks:
+            await asyncio.gather(*tasks, return_exceptions=True)
+
+
+stepper = QuantityStepper()
@@ -0,0 +1,262 @@
+import asyncio
+import contextvars
+import heapq
+import itertools
+import logging
+import time
+from contextlib import contextmanager
+
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware
+from aiogram.exceptions import TelegramNetworkError, TelegramRetryAfter, TelegramServerError
+from aiogram.methods import SendInvoice, SendMessage
+
+import config
+
+logger = logging.getLogger(__name__)
+
+# Полосы приоритета: чем меньше число, тем раньше уходит сообщение
+PAYMENT = 0
+DEFAULT = 1
+BULK = 2
+
+MAX_MESSAGE_LENGTH = 4096
+
+_priority = contextvars.ContextVar('send_priority', default=None)
+
+
+@contextmanager
+def priority(level):
+    token = _priority.set(level)
+    try:
+        yield
+    finally:
+        _priority.reset(token)
+
+
+async def together(*requests):
+    # Запросы ставятся в очередь сразу, не дожидаясь отправки предыдущего: только так подряд идущие
+    # тексты одному чату попадают в очередь вместе и склеиваются. Порядок внутри чата сохраняется
+    # Методы aiogram (message.reply и т.п.) - не корутины, поэтому оборачиваем в задачи явно
+    return await asyncio.gather(*(asyncio.ensure_future(request) for request in requests))
+
+
+class TokenBucket:
+    __slots__ = ('rate', 'capacity', 'tokens', 'updated')
+
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def take(self):
+        # Возвращает 0, если токен взят, иначе - сколько секунд ждать следующего
+        self._refill()
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0
+        return (1 - self.tokens) / self.rate
+
+    def is_full(self):
+        self._refill()
+        return self.tokens >= self.capacity
+
+
+class _Job:
+    __slots__ = ('priority', 'seq', 'make_request', 'bot', 'method', 'future')
+
+    def __init__(self, priority, seq, make_request, bot, method):
+        self.priority = priority
+        self.seq = seq
+        self.make_request = make_request
+        self.bot = bot
+        self.method = method
+        self.future = asyncio.get_running_loop().create_future()
+
+
+class _Chat:
+    __slots__ = ('chat_id', 'bucket', 'jobs', 'busy', 'waiting')
+
+    def __init__(self, chat_id, bucket):
+        self.chat_id = chat_id
+        self.bucket = bucket
+        self.jobs = []
+        self.busy = False
+        self.waiting = False
+
+
+def _can_merge(first, second):
+    return (
+        isinstance(first, SendMessage) and isinstance(second, SendMessage)
+        and first.reply_markup is None
+        and first.entities is None and second.entities is None
+        and first.parse_mode == second.parse_mode
+        and first.message_thread_id == second.message_thread_id
+        and second.reply_parameters in (None, first.reply_parameters)
+    )
+
+
+class SendScheduler(BaseRequestMiddleware):
+    def __init__(self, global_rate=config.SEND_GLOBAL_RATE / max(config.WORKERS, 1),
+                 chat_rate=config.SEND_CHAT_RATE, chat_burst=config.SEND_CHAT_BURST,
+                 group_rate=config.SEND_GROUP_RATE, max_retries=config.SEND_MAX_RETRIES):
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.group_rate = group_rate
+        self.max_retries = max_retries
+        self._global = TokenBucket(global_rate, max(global_rate, 1))
+        self._chats = {}
+        self._ready = []
+        self._seq = itertools.count()
+        self._wakeup = asyncio.Event()
+        self._idle = asyncio.Event()
+        self._idle.set()
+        self._inflight = 0
+        self._task = None
+
+    async def __call__(self, make_request, bot, method):
+        chat_id = getattr(method, 'chat_id', None)
+        # Ответы на callback и pre-checkout, getUpdates и т.п. не привязаны к чату и идут напрямую
+        if chat_id is None:
+            return await make_request(bot, method)
+
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+        level = _priority.get()
+        if level is None:
+            level = PAYMENT if isinstance(method, SendInvoice) else DEFAULT
+        job = _Job(level, next(self._seq), make_request, bot, method)
+
+        chat = self._chats.get(chat_id)
+        if chat is None:
+            rate = self.group_rate if isinstance(chat_id, int) and chat_id < 0 else self.chat_rate
+            chat = self._chats[chat_id] = _Chat(chat_id, TokenBucket(rate, self.chat_burst))
+        # Внутри чата порядок - по приоритету, а при равном приоритете - по времени постановки
+        index = len(chat.jobs)
+        while index and (chat.jobs[index - 1].priority, chat.jobs[index - 1].seq) > (job.priority, job.seq):
+            index -= 1
+        chat.jobs.insert(index, job)
+
+        self._inflight += 1
+        self._idle.clear()
+        self._schedule(chat)
+        return await job.future
+
+    def _schedule(self, chat):
+        if chat.jobs and not chat.busy and not chat.waiting:
+            head = chat.jobs[0]
+            heapq.heappush(self._ready, (head.priority, head.seq, chat.chat_id))
+            self._wakeup.set()
+
+    def _resume(self, chat):
+        chat.waiting = False
+        self._schedule(chat)
+
+    def _take(self, chat):
+        jobs = [chat.jobs.pop(0)]
+        length = len(getattr(jobs[0].method, 'text', '') or '')
+        # Подряд идущие текстовые сообщения одному чату склеиваем в одно
+        while chat.jobs and _can_merge(jobs[-1].method, chat.jobs[0].method):
+            length += 2 + len(chat.jobs[0].method.text)
+            if length > MAX_MESSAGE_LENGTH:
+                break
+            jobs.append(chat.jobs.pop(0))
+        return jobs
+
+    def _sweep(self):
+        for chat_id, chat in list(self._chats.items()):
+            if not chat.jobs and not chat.busy and not chat.waiting and chat.bucket.is_full():
+                del self._chats[chat_id]
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        swept_at = time.monotonic()
+        while True:
+            if not self._ready:
+                self._wakeup.clear()
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), timeout=60)
+                except asyncio.TimeoutError:
+                    pass
+                if time.monotonic() - swept_at >= 60:
+                    self._sweep()
+                    swept_at = time.monotonic()
+                continue
+
+            _, _, chat_id = heapq.heappop(self._ready)
+            chat = self._chats.get(chat_id)
+            if chat is None or chat.busy or chat.waiting or not chat.jobs:
+                continue
+
+            delay = chat.bucket.take()
+            if delay:
+                chat.waiting = True
+                loop.call_later(delay, self._resume, chat)
+                continue
+
+            while delay := self._global.take():
+                await asyncio.sleep(delay)
+
+            chat.busy = True
+            asyncio.create_task(self._send(chat, self._take(chat)))
+
+    async def _send(self, chat, jobs):
+        first = jobs[0]
+        method = first.method
+        if len(jobs) > 1:
+            method = method.model_copy(update={
+                'text': '\n\n'.join(job.method.text for job in jobs),
+                'reply_markup': jobs[-1].method.reply_markup
+            })
+
+        try:
+            for attempt in range(self.max_retries + 1):
+                try:
+                    result = await first.make_request(first.bot, method)
+                except TelegramRetryAfter as e:
+                    if attempt == self.max_retries:
+                        raise
+                    logger.warning('Flood control в чате %s, ждём %s с', chat.chat_id, e.retry_after,
+                                   extra={'chat_id': chat.chat_id, 'retry_after': e.retry_after})
+                    await asyncio.sleep(e.retry_after)
+                except (TelegramNetworkError, TelegramServerError):
+                    if attempt == self.max_retries:
+                        raise
+                    await asyncio.sleep(0.5 * 2 ** attempt)
+                else:
+                    for job in jobs:
+                        if not job.future.done():
+                            job.future.set_result(result)
+                    break
+        except Exception as e:
+            for job in jobs:
+                if not job.future.done():
+                    job.future.set_exception(e)
+        finally:
+            chat.busy = False
+            self._schedule(chat)
+            self._inflight -= len(jobs)
+            if not self._inflight:
+                self._idle.set()
+
+    async def close(self, timeout=10):
+        try:
+            await asyncio.wait_for(self._idle.wait(), timeout=timeout)
+        except asyncio.TimeoutError:
+            logger.warning('Не все сообщения отправлены до остановки: %d', self._inflight)
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+
+scheduler = SendScheduler()
@@ -0,0 +1,244 @@
+import asyncio
+import json
+import logging
+import multiprocessing
+import signal
+import socket
+from collections import deque
+
+from aiohttp import web
+
+import config
+import database
+import lifecycle
+
+logger = logging.getLogger(__name__)
+
+# Обновления передаются воркерам построчно в JSON, одно сообщение может быть большим
+STREAM_LIMIT = 4 * 1024 * 1024
+
+STOP_SIGNALS = (signal.SIGINT, signal.SIGTERM)
+
+
+# (номер воркера, число воркеров) в текущем процессе; None - бот работает одним процессом
+worker = None
+
+
+def shard_for(key, workers):
+    return hash(key) % workers
+
+
+def owns(key):
+    # Обрабатывает ли этот процесс ключ key: фоновые задачи, которые должен вести ровно один воркер
+    return worker is None or shard_for(key, worker[1]) == worker[0]
+
+
+def update_user_id(raw):
+    for key, event in raw.items():
+        if key == 'update_id' or not isinstance(event, dict):
+            continue
+        for field in ('from', 'user', 'chat'):
+            owner = event.get(field)
+            if isinstance(owner, dict) and 'id' in owner:
+                return owner['id']
+    return None
+
+
+# События одного ключа обрабатываются строго по порядку, разных ключей - параллельно
+class UserSerializer:
+    def __init__(self, handle):
+        self._handle = handle
+        self._queues = {}
+        self._tasks = set()
+
+    def submit(self, key, item):
+        queue = self._queues.get(key)
+        if queue is not None:
+            queue.append(item)
+            return
+
+        self._queues[key] = deque([item])
+        task = asyncio.create_task(self._drain(key))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _drain(self, key):
+        queue = self._queues[key]
+        try:
+            while queue:
+                item = queue.popleft()
+                try:
+                    await self._handle(item)
+                except Exception:
+                    logger.exception('Ошибка при обработке обновления')
+        finally:
+            del self._queues[key]
+
+    async def join(self, timeout=None):
+        if self._tasks:
+            await asyncio.wait(set(self._tasks), timeout=timeout)
+
+
+class ShardRouter:
+    def __init__(self, writers):
+        self._writers = writers
+
+    async def route(self, raw):
+        user_id = update_user_id(raw)
+        key = user_id if user_id is not None else raw.get('update_id', 0)
+        writer = self._writers[shard_for(key, len(self._writers))]
+        writer.write(json.dumps(raw, ensure_ascii=False, separators=(',', ':')).encode() + b'\n')
+        await writer.drain()
+
+
+async def _serve_worker(bot, dp, startup, shutdown, sock):
+    reader, writer = await asyncio.open_connection(sock=sock, limit=STREAM_LIMIT)
+    loop = asyncio.get_running_loop()
+    # Останавливает воркеры фронт-процесс, закрывая канал
+    for sig in STOP_SIGNALS:
+        loop.add_signal_handler(sig, lambda: None)
+
+    try:
+        # Как и в bot.main: при сбое запуска shutdown всё равно закрывает базу
+        await startup()
+        lifecycle.set_ready(True, systemd=False)
+        serializer = UserSerializer(lambda raw: dp.feed_raw_update(bot, raw))
+        while line := await reader.readline():
+            raw = json.loads(line)
+            user_id = update_user_id(raw)
+            serializer.submit(user_id if user_id is not None else ('update', raw.get('update_id')), raw)
+        lifecycle.set_ready(False, systemd=False)
+        await serializer.join(timeout=config.SHUTDOWN_TIMEOUT)
+    finally:
+        writer.close()
+        await shutdown()
+
+
+def _worker_main(bot, dp, startup, shutdown, index, pairs):
+    # Унаследованные чужие концы каналов нужно закрыть, иначе воркер не увидит EOF
+    for number, (front_sock, worker_sock) in enumerate(pairs):
+        front_sock.close()
+        if number != index:
+            worker_sock.close()
+    global worker
+    worker = (index, len(pairs))
+    # У каждого воркера свои метрики, поэтому и свой порт
+    if config.METRICS_PORT:
+        config.METRICS_PORT += index + 1
+    logger.info('Воркер %d запущен', index)
+    asyncio.run(_serve_worker(bot, dp, startup, shutdown, pairs[index][1]))
+
+
+async def _poll(bot, dp, router):
+    offset = None
+    allowed_updates = dp.resolve_used_update_types()
+    while True:
+        try:
+            updates = await bot.get_updates(offset=offset, timeout=30, allowed_updates=allowed_updates)
+        except Exception as e:
+            logger.error('Ошибка при получении обновлений: %s', e)
+            await asyncio.sleep(1)
+            continue
+
+        for update in updates:
+            await router.route(update.model_dump(mode='json', by_alias=True, exclude_unset=True))
+            offset = update.update_id + 1
+
+
+async def _serve_webhook(bot, dp, router):
+    async def handle(request):
+        if config.WEBHOOK_SECRET and request.headers.get('X-Telegram-Bot-Api-Secret-Token') != config.WEBHOOK_SECRET:
+            return web.Response(status=401)
+        await router.route(await request.json())
+        return web.json_response({})
+
+    app = web.Application()
+    app.router.add_post(config.WEBHOOK_PATH, handle)
+    runner = web.AppRunner(app, handle_signals=False)
+    await runner.setup()
+    site = web.TCPSite(runner, config.WEBHOOK_HOST, config.WEBHOOK_PORT)
+    await site.start()
+
+    if config.WEBHOOK_URL:
+        await bot.set_webhook(
+            url=config.WEBHOOK_URL.rstrip('/') + config.WEBHOOK_PATH,
+            secret_token=config.WEBHOOK_SECRET or None,
+            allowed_updates=dp.resolve_used_update_types()
+        )
+    try:
+        await asyncio.Event().wait()
+    finally:
+        await runner.cleanup()
+
+
+async def _run_front(bot, dp, socks):
+    writers = []
+    watchers = []
+    for sock in socks:
+        reader, writer = await asyncio.open_connection(sock=sock)
+        writers.append(writer)
+        # Воркеры ничего не пишут в ответ: EOF означает, что процесс воркера завершился
+        watchers.append(asyncio.create_task(reader.read()))
+
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in STOP_SIGNALS:
+        loop.add_signal_handler(sig, stop.set)
+
+    router = ShardRouter(writers)
+    intake = _serve_webhook if config.BOT_MODE == 'webhook' else _poll
+    intake_task = asyncio.create_task(intake(bot, dp, router))
+    stop_task = asyncio.create_task(stop.wait())
+    lifecycle.notify_systemd('READY=1')
+    try:
+        done, _ = await asyncio.wait([intake_task, stop_task, *watchers], return_when=asyncio.FIRST_COMPLETED)
+        if any(watcher in done for watcher in watchers):
+            logger.error('Один из воркеров неожиданно завершился, останавливаемся')
+        if intake_task in done:
+            intake_task.result()
+    finally:
+        lifecycle.notify_systemd('STOPPING=1')
+        for task in (intake_task, stop_task, *watchers):
+            task.cancel()
+        await asyncio.gather(intake_task, stop_task, *watchers, return_exceptions=True)
+        for writer in writers:
+            writer.close()
+        await bot.session.close()
+
+
+def start_workers(bot, dp, startup, shutdown, workers):
+    # Запускает воркеры и возвращает процессы и концы каналов, в которые фронт пишет обновления
+    if isinstance(database.pool, database.MemoryStorage):
+        raise RuntimeError('База в памяти не разделяется между процессами: укажите файл в DATABASE_PATH')
+    # fork, а не spawn: воркеры наследуют уже настроенные bot и dp
+    context = multiprocessing.get_context('fork')
+    pairs = [socket.socketpair() for _ in range(workers)]
+
+    processes = []
+    for index in range(workers):
+        process = context.Process(
+            target=_worker_main,
+            args=(bot, dp, startup, shutdown, index, pairs),
+            name=f'bot-worker-{index}'
+        )
+        process.start()
+        processes.append(process)
+
+    for _, worker_sock in pairs:
+        worker_sock.close()
+    return processes, [front_sock for front_sock, _ in pairs]
+
+
+def join_workers(processes):
+    for process in processes:
+        process.join(timeout=config.SHUTDOWN_TIMEOUT + 5)
+        if process.is_alive():
+            process.terminate()
+
+
+def run(bot, dp, startup, shutdown, workers):
+    processes, socks = start_workers(bot, dp, startup, shutdown, workers)
+    try:
+        asyncio.run(_run_front(bot, dp, socks))
+    finally:
+        join_workers(processes)
@@ -0,0 +1,70 @@
+import asyncio
+import logging
+import sys
+import threading
+import time
+import traceback
+
+import config
+import metrics
+
+logger = logging.getLogger(__name__)
+
+loop_stalls = metrics.Counter('bot_loop_stalls_total', 'Блокировки цикла событий дольше порога')
+
+
+class LoopWatchdog:
+    # Отдельный поток следит за пульсом цикла событий и при зависании снимает стек потока цикла
+    def __init__(self, threshold_ms=config.LOOP_STALL_THRESHOLD_MS):
+        self.threshold = threshold_ms / 1000
+        self.interval = self.threshold / 4
+        self._loop = None
+        self._loop_thread_id = None
+        self._beat = 0.0
+        self._handle = None
+        self._thread = None
+        self._stopped = threading.Event()
+
+    def _tick(self):
+        self._beat = time.monotonic()
+        self._handle = self._loop.call_later(self.interval, self._tick)
+
+    def _watch(self):
+        reported = None
+        while not self._stopped.wait(self.interval):
+            beat = self._beat
+            stalled = time.monotonic() - beat
+            if stalled < self.threshold or beat == reported:
+                continue
+            # Об одном зависании сообщаем один раз, со стеком того места, где цикл стоит сейчас
+            reported = beat
+            loop_stalls.inc()
+            frame = sys._current_frames().get(self._loop_thread_id)
+            stack = ''.join(traceback.format_stack(frame)) if frame is not None else ''
+            logger.warning('Цикл событий заблокирован уже %.0f мс:\n%s', stalled * 1000, stack,
+                           extra={'stall_ms': round(stalled * 1000)})
+
+    def start(self):
+        if not self.threshold or self._thread is not None:
+            return
+        self._loop = asyncio.get_running_loop()
+        self._loop_thread_id = threading.get_ident()
+        # Встроенный отладочный режим asyncio дополнительно называет медленные callback'и
+        self._loop.set_debug(True)
+        self._loop.slow_callback_duration = self.threshold
+        self._stopped.clear()
+        self._tick()
+        self._thread = threading.Thread(target=self._watch, name='loop-watchdog', daemon=True)
+        self._thread.start()
+        logger.info('Отладка блокировок цикла событий включена, порог %.0f мс', self.threshold * 1000)
+
+    def stop(self):
+        if self._thread is None:
+            return
+        self._stopped.set()
+        self._handle.cancel()
+        self._thread.join()
+        self._thread = None
+
+
+monitor = LoopWatchdog()
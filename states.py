@@ -0,0 +1,110 @@
+import asyncio
+import logging
+from collections import OrderedDict
+
+import config
+import database
+
+logger = logging.getLogger(__name__)
+
+_MISSING = object()
+
+
+class UserStateStore:
+    def __init__(self, max_size=config.STATE_CACHE_SIZE,
+                 flush_interval=config.STATE_FLUSH_INTERVAL,
+                 flush_batch=config.STATE_FLUSH_BATCH):
+        self.max_size = max_size
+        self.flush_interval = flush_interval
+        self.flush_batch = flush_batch
+        self._states = OrderedDict()
+        self._dirty = {}
+        self._flushing = {}
+        self._wakeup = asyncio.Event()
+        self._flush_lock = asyncio.Lock()
+        self._task = None
+
+    def _remember(self, user_id, state):
+        self._states[user_id] = state
+        self._states.move_to_end(user_id)
+        if len(self._states) > self.max_size:
+            self._states.popitem(last=False)
+
+    async def get(self, user_id):
+        # Несохранённые изменения важнее того, что лежит в базе
+        state = self._dirty.get(user_id, _MISSING)
+        if state is _MISSING:
+            state = self._flushing.get(user_id, _MISSING)
+        if state is _MISSING:
+            state = self._states.get(user_id, _MISSING)
+        if state is _MISSING:
+            state = await database.async_get_user_state(user_id)
+            if user_id in self._dirty or user_id in self._flushing:
+                return await self.get(user_id)
+        self._remember(user_id, state)
+        return state
+
+    async def set(self, user_id, state):
+        self._remember(user_id, state)
+        self._dirty[user_id] = state
+
+        if len(self._dirty) >= self.flush_batch:
+            self._wakeup.set()
+        # Если запись не успевает за изменениями, ждём сброса, чтобы не расти без границ
+        if len(self._dirty) >= self.flush_batch * 4:
+            await self.flush()
+
+    async def flush(self):
+        async with self._flush_lock:
+            if not self._dirty:
+                return
+
+            self._flushing, self._dirty = self._dirty, {}
+            try:
+                await database.async_save_user_states(list(self._flushing.items()))
+            except BaseException as e:
+                if isinstance(e, Exception):
+                    logger.exception('Не удалось сохранить %d состояний пользователей', len(self._flushing))
+                # Возвращаем пачку в очередь, не затирая более свежие изменения
+                for user_id, state in self._flushing.items():
+                    self._dirty.setdefault(user_id, state)
+                raise
+            finally:
+                self._flushing = {}
+
+    async def forget(self, user_ids):
+        # Ждём идущий сброс, чтобы он не вернул в базу состояния удаляемых пользователей
+        async with self._flush_lock:
+            for user_id in user_ids:
+                self._states.pop(user_id, None)
+                self._dirty.pop(user_id, None)
+
+    async def _run(self):
+        while True:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+
+            try:
+                await self.flush()
+            except Exception:
+                await asyncio.sleep(self.flush_interval)
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        await self.flush()
+
+
+store = UserStateStore()
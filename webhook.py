@@ -0,0 +1,58 @@
+import asyncio
+import logging
+import signal
+
+from aiohttp import web
+from aiogram.webhook.aiohttp_server import SimpleRequestHandler, setup_application
+
+import config
+import lifecycle
+
+logger = logging.getLogger(__name__)
+
+
+def create_app(bot, dp):
+    app = web.Application()
+    handler = SimpleRequestHandler(
+        dispatcher=dp,
+        bot=bot,
+        handle_in_background=True,
+        secret_token=config.WEBHOOK_SECRET or None
+    )
+    # Не handler.register(): он закрывает сессию бота вместе с приложением,
+    # а сессия нужна до конца остановки, пока не отправлены ответы из очереди
+    app.router.add_post(config.WEBHOOK_PATH, handler.handle)
+    setup_application(app, dp, bot=bot)
+    return app
+
+
+async def run_webhook(bot, dp):
+    app = create_app(bot, dp)
+    runner = web.AppRunner(app, handle_signals=False)
+    await runner.setup()
+    site = web.TCPSite(runner, config.WEBHOOK_HOST, config.WEBHOOK_PORT)
+    await site.start()
+
+    if config.WEBHOOK_URL:
+        await bot.set_webhook(
+            url=config.WEBHOOK_URL.rstrip('/') + config.WEBHOOK_PATH,
+            secret_token=config.WEBHOOK_SECRET or None,
+            allowed_updates=dp.resolve_used_update_types()
+        )
+    logger.info('Webhook слушает %s:%s%s', config.WEBHOOK_HOST, config.WEBHOOK_PORT, config.WEBHOOK_PATH)
+
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stop.set)
+
+    try:
+        await stop.wait()
+    finally:
+        for sig in (signal.SIGINT, signal.SIGTERM):
+            loop.remove_signal_handler(sig)
+        # Сначала перестаём принимать запросы, затем дожидаемся уже принятых
+        lifecycle.set_ready(False)
+        await site.stop()
+        await lifecycle.inflight.drain(config.SHUTDOWN_TIMEOUT)
+        await runner.cleanup()